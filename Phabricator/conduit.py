@@ -0,0 +1,262 @@
+###
+# Copyright (c) 2018 Software Heritage Developers
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""Conduit API client sharing a pool of keep-alive connections between
+the plugin's threads."""
+
+import json
+import time
+import threading
+import concurrent.futures
+
+import phabricator
+import requests
+import requests.adapters
+
+
+class ConduitMethod:
+    """Attribute of a Conduit client, callable as a Conduit method, so
+    ``conduit.diffusion.repository.search(**kwargs)`` calls the
+    ``diffusion.repository.search`` method."""
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return ConduitMethod(self._client, '%s.%s' % (self._name, name))
+
+    def __call__(self, **kwargs):
+        return self._client.call(self._name, **kwargs)
+
+
+class ConduitUnavailable(Exception):
+    """Raised instead of calling a host which does not answer."""
+
+
+class CircuitBreaker:
+    """Counts the consecutive failed calls to a host. After
+    failure_threshold of them, calls are rejected for cooldown seconds;
+    then a single call is let through, and closes the circuit again if
+    it succeeds."""
+    def __init__(self, failure_threshold=5, cooldown=60):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trying = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """'closed', 'open' (calls are rejected) or 'half-open' (the
+        next call is let through)."""
+        if self.opened_at is None:
+            return 'closed'
+        elif time.time() < self.opened_at + self.cooldown:
+            return 'open'
+        else:
+            return 'half-open'
+
+    def before_call(self):
+        """Raises ConduitUnavailable if the call must be rejected."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trying or \
+                    time.time() < self.opened_at + self.cooldown:
+                raise ConduitUnavailable(
+                    'Too many failed calls, retrying in %d seconds' %
+                    max(self.opened_at + self.cooldown - time.time(), 0))
+            self._trying = True
+
+    def after_call(self):
+        """Lets the next call through, if the one let through by
+        before_call ended without recording its outcome."""
+        with self._lock:
+            self._trying = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trying = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trying = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+class InFlightCall:
+    """A Conduit call being sent, whose result is shared with the threads
+    making the same call in the meantime."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Conduit:
+    """Drop-in replacement for phabricator.Phabricator, sending all the
+    calls to a host through a single pool of keep-alive connections.
+
+    Calls are sent by a pool of pool_size threads; callers wait for them
+    at most call_timeout seconds, and stop calling the host for a while
+    after failure_threshold consecutive failures (see CircuitBreaker)."""
+    def __init__(self, host, token, pool_size=4, connect_timeout=5,
+                 read_timeout=5, call_timeout=15, failure_threshold=5,
+                 cooldown=60):
+        self.host = host
+        self.token = token
+        self.timeout = (connect_timeout, read_timeout)
+        self.call_timeout = call_timeout
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix='Conduit')
+        self.interfaces = phabricator.parse_interfaces(phabricator.INTERFACES)
+        # None until the host's description is set
+        self.interfaces_fetch_time = None
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return ConduitMethod(self, name)
+
+    def update_interfaces(self):
+        """Replaces the default description of the Conduit methods with the
+        one of the host."""
+        self.set_interfaces(self.fetch_interfaces())
+
+    def fetch_interfaces(self):
+        """Returns the host's description of its Conduit methods, as
+        returned by conduit.query."""
+        return self.call('conduit.query').response
+
+    def set_interfaces(self, interfaces, fetch_time=None):
+        """Sets the description of the Conduit methods, fetched from the
+        host at fetch_time (now by default)."""
+        self.interfaces = phabricator.parse_interfaces(interfaces)
+        if fetch_time is None:
+            fetch_time = time.time()
+        self.interfaces_fetch_time = fetch_time
+
+    def check_arguments(self, method, kwargs):
+        (app, _, name) = method.partition('.')
+        interface = self.interfaces.get(app, {}).get(name, {})
+        for key in interface.get('required', {}):
+            if key not in kwargs:
+                raise ValueError('Missing required argument: %s' % key)
+
+    def call(self, method, **kwargs):
+        """Calls a Conduit method, and returns its result as a
+        phabricator.Result.
+
+        If the same call is already being sent by another thread, waits for
+        it and returns its result instead of sending it again."""
+        self.check_arguments(method, kwargs)
+        key = (method, json.dumps(kwargs, sort_keys=True))
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                call = self._in_flight[key] = InFlightCall()
+        if in_flight is not None:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            self.breaker.before_call()
+            try:
+                call.result = self._send_with_deadline(method, kwargs)
+            finally:
+                self.breaker.after_call()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+            call.done.set()
+        return call.result
+
+    def _send_with_deadline(self, method, kwargs):
+        future = self._executor.submit(self._send, method, kwargs)
+        try:
+            result = future.result(timeout=self.call_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.breaker.record_failure()
+            raise ConduitUnavailable('%s%s did not answer in %s seconds' %
+                                     (self.host, method, self.call_timeout))
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            # The host answered, with an error
+            self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def _send(self, method, kwargs):
+        params = dict(kwargs)
+        params['__conduit__'] = {'token': self.token}
+        response = self.session.post(
+            '%s%s' % (self.host, method),
+            data={'params': json.dumps(params), 'output': 'json'},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+
+        data = response.json()
+        # Errors return 200, so check response content for exception
+        if data['error_code']:
+            raise phabricator.APIError(data['error_code'], data['error_info'])
+        return phabricator.Result(data['result'])
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -85,6 +85,33 @@ conf.registerChannelValue(
     ))
 )
 
+conf.registerChannelValue(
+    Phabricator.announce, 'maxInterval',
+    registry.PositiveInteger(900, _(
+        """The maximum interval between two queries to Phabricator's
+        feed API. While the feed has no new stories, the interval is
+        doubled after each query, up to this value; it goes back to
+        announce.interval as soon as there are new stories."""
+    ))
+)
+
+
+conf.registerChannelValue(
+    Phabricator.announce, 'digestThreshold',
+    registry.NonNegativeInteger(10, _(
+        """When more than this number of new stories are announced at
+        once, they are summarized with a line per author instead of a line
+        per story. 0 disables it."""
+    ))
+)
+
+conf.registerGlobalValue(
+    Phabricator.announce, 'backlog',
+    registry.NonNegativeInteger(20, _(
+        """The maximum number of stories announced when the bot starts,
+        for the stories published since it was stopped. 0 disables it."""
+    ))
+)
 
 conf.registerChannelValue(
     Phabricator.announce, 'usernameBlacklist',
@@ -93,5 +120,128 @@ conf.registerChannelValue(
     ))
 )
 
+conf.registerGlobalValue(
+    Phabricator.announce, 'push',
+    registry.Boolean(False, _(
+        """Determines whether the bot receives Phabricator's feed
+        HTTP hooks (feed.http-hooks) on its HTTP server, at
+        /phabricator/<host of phabricatorURI>. Each hook makes the bot read
+        the new stories of the instance's feed right away; instances which
+        sent a hook in the last announce.push.fallbackInterval seconds are
+        only polled at that interval."""
+    ))
+)
+
+conf.registerGlobalValue(
+    Phabricator.announce.push, 'fallbackInterval',
+    registry.PositiveInteger(900, _(
+        """The interval between two queries to the feed API of an
+        instance whose stories are pushed with HTTP hooks, in case some
+        hooks are lost."""
+    ))
+)
+
+conf.registerChannelValue(
+    Phabricator, 'replyCooldown',
+    registry.NonNegativeInteger(0, _(
+        """Time (in seconds) during which the bot does not repeat an
+        identical reply about the same object on the channel; 0 disables
+        it."""
+    ))
+)
+
+conf.registerGlobalValue(
+    Phabricator, 'cacheSize',
+    registry.PositiveInteger(10000, _(
+        """Maximum number of objects (and of transactions) kept in the
+        in-memory caches; the least recently used ones are evicted
+        first."""
+    ))
+)
+
+
+conf.registerGlobalValue(
+    Phabricator, 'persistentCache',
+    registry.Boolean(False, _(
+        """Determines whether objects fetched from Phabricator are also
+        cached in a database in the data directory, so the cache is kept
+        across restarts."""
+    ))
+)
+
+
+conf.registerGlobalValue(
+    Phabricator, 'warmUp',
+    registry.Boolean(False, _(
+        """Determines whether the bot fetches all the users and
+        repositories of the Phabricator instances it uses when it starts,
+        and every few hours, so they are almost always found in its caches.
+        The cacheSize should be large enough to hold all the users."""
+    ))
+)
+
+
+conf.registerGlobalValue(
+    Phabricator, 'commitIndex',
+    registry.Boolean(False, _(
+        """Determines whether the bot keeps an index of the commits known
+        to Phabricator, so it can ignore hexadecimal words which are not
+        commits without querying Phabricator."""
+    ))
+)
+
+
+conf.registerGroup(Phabricator, 'conduit')
+
+conf.registerGlobalValue(
+    Phabricator.conduit, 'poolSize',
+    registry.PositiveInteger(4, _(
+        """Maximum number of keep-alive connections kept open to each
+        Phabricator instance."""
+    ))
+)
+
+conf.registerGlobalValue(
+    Phabricator.conduit, 'connectTimeout',
+    registry.PositiveFloat(5, _(
+        """Time (in seconds) to wait for a connection to Phabricator to
+        be established."""
+    ))
+)
+
+conf.registerGlobalValue(
+    Phabricator.conduit, 'readTimeout',
+    registry.PositiveFloat(5, _(
+        """Time (in seconds) to wait for Phabricator to answer a Conduit
+        call."""
+    ))
+)
+
+conf.registerGlobalValue(
+    Phabricator.conduit, 'callTimeout',
+    registry.PositiveFloat(15, _(
+        """Maximum time (in seconds) a Conduit call may take, including
+        the time it waits for a free connection."""
+    ))
+)
+
+conf.registerGlobalValue(
+    Phabricator.conduit, 'failureThreshold',
+    registry.PositiveInteger(5, _(
+        """Number of consecutive failed Conduit calls after which the
+        bot stops calling the Phabricator instance for
+        conduit.cooldown seconds."""
+    ))
+)
+
+conf.registerGlobalValue(
+    Phabricator.conduit, 'cooldown',
+    registry.PositiveInteger(60, _(
+        """Time (in seconds) during which the bot does not call a
+        Phabricator instance, after conduit.failureThreshold consecutive
+        failed calls."""
+    ))
+)
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -29,20 +29,30 @@
 ###
 
 import re
+import sys
+import json
 import time
-import operator
+import heapq
+import random
+import sqlite3
 import threading
-from collections import defaultdict, namedtuple
-
-import phabricator
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, defaultdict, namedtuple
 
+import supybot.conf as conf
 import supybot.utils as utils
 from supybot.commands import *
 import supybot.world as world
 import supybot.plugins as plugins
+import supybot.schedule as schedule
+import supybot.httpserver as httpserver
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
+
+from .conduit import Conduit
+
 try:
     from supybot.i18n import PluginInternationalization
     _ = PluginInternationalization('Phabricator')
@@ -51,9 +61,575 @@ except ImportError:
     # without the i18n module
     _ = lambda x: x
 
-feed_announce = namedtuple('feed_announce', 'fetch_time max_epoch')
 cache_entry = namedtuple('phid_cache_entry', 'data expiry')
 
+
+class Record:
+    """Mixin for the namedtuples holding the few fields of Conduit
+    results the plugin uses, so they can still be read like the results,
+    as record['name']."""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return super().__getitem__(key)
+
+    @classmethod
+    def from_json(cls, data):
+        """Returns the record serialized as data, which may also be a full
+        Conduit result cached by older versions of the plugin."""
+        if isinstance(data, dict):
+            return cls.from_conduit(data)
+        return cls(*data)
+
+
+class ObjectRecord(Record, namedtuple('ObjectRecord',
+                                      'phid type name fullName uri status')):
+    __slots__ = ()
+
+    @classmethod
+    def from_conduit(cls, obj):
+        """Returns the record of a phid.query result."""
+        return cls(
+            phid=obj['phid'],
+            type=sys.intern(obj['type']),
+            name=obj['name'],
+            fullName=obj['fullName'],
+            uri=obj['uri'],
+            status=sys.intern(obj['status']),
+        )
+
+    @classmethod
+    def from_user_search(cls, user, host):
+        """Returns the record phid.query would return for a
+        user.search result, from the given Conduit host."""
+        username = user['fields']['username']
+        return cls(
+            phid=user['phid'],
+            type=sys.intern(user['type']),
+            name=username,
+            fullName='%s (%s)' % (username, user['fields']['realName']),
+            uri=urllib.parse.urljoin(host, '/p/%s/' % username),
+            status=sys.intern('closed' if 'disabled' in
+                              user['fields'].get('roles', []) else 'open'),
+        )
+
+
+class TransactionRecord(Record, namedtuple('TransactionRecord',
+                                           'phid id authorPHID type')):
+    __slots__ = ()
+
+    @classmethod
+    def from_conduit(cls, trans):
+        """Returns the record of a transaction.search result."""
+        return cls(
+            phid=trans['phid'],
+            id=trans['id'],
+            authorPHID=trans['authorPHID'],
+            type=sys.intern(trans['type']),
+        )
+
+
+class PhidCache:
+    """Thread-safe cache of cache_entry objects, holding at most max_size
+    of them; the least recently used entries are evicted first, and
+    expired entries are dropped when looked up."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the cache_entry of the key, or None if it is missing
+        or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expiry <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+class PersistentCache:
+    """SQLite-backed copy of the PHID caches, so they survive restarts
+    and reloads.
+
+    The database is only opened on first use, and entries are read from it
+    on cache misses; writes are buffered and flushed in batches."""
+    batch_size = 100
+    flush_interval = 60
+    schema_version = 1
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._db = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.time()
+
+    def _connect(self):
+        # Must be called with self._lock held.
+        if self._db is None:
+            self._db = sqlite3.connect(self._filename,
+                                       check_same_thread=False)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS cache (
+                                    name TEXT,
+                                    key TEXT,
+                                    data TEXT,
+                                    expiry REAL,
+                                    PRIMARY KEY (name, key))''')
+            (version,) = self._db.execute('PRAGMA user_version').fetchone()
+            if version < self.schema_version:
+                # Keys written by older versions contained Conduit tokens.
+                self._db.execute('DELETE FROM cache')
+                self._db.execute('PRAGMA user_version = %d' %
+                                 self.schema_version)
+            self._db.commit()
+        return self._db
+
+    def get_many(self, name, keys):
+        """Returns a dict mapping the given keys to the cache_entry stored
+        for them, ignoring expired and missing entries."""
+        now = time.time()
+        entries = {}
+        with self._lock:
+            db = self._connect()
+            for key in keys:
+                skey = json.dumps(key)
+                entry = self._pending.get((name, skey))
+                if entry is None:
+                    row = db.execute('''SELECT data, expiry FROM cache
+                                        WHERE name=? AND key=?''',
+                                     (name, skey)).fetchone()
+                    if row:
+                        entry = cache_entry(json.loads(row[0]), row[1])
+                if entry and entry.expiry > now:
+                    entries[key] = entry
+        return entries
+
+    def set(self, name, key, entry):
+        """Stores an entry; it is actually written on the next flush."""
+        with self._lock:
+            self._pending[name, json.dumps(key)] = entry
+            if len(self._pending) >= self.batch_size \
+                    or self._last_flush + self.flush_interval < time.time():
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # Must be called with self._lock held.
+        db = self._connect()
+        db.executemany('''INSERT OR REPLACE INTO cache
+                          VALUES (?, ?, ?, ?)''',
+                       [(name, skey, json.dumps(entry.data), entry.expiry)
+                        for ((name, skey), entry) in self._pending.items()])
+        db.execute('DELETE FROM cache WHERE expiry < ?', (time.time(),))
+        db.commit()
+        self._pending = {}
+        self._last_flush = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._db is None and not self._pending:
+                return
+            self._flush()
+            self._db.close()
+            self._db = None
+
+
+class CommitIndex:
+    """Prefixes of the hashes of the commits known to a Phabricator
+    instance, used to tell a hexadecimal word is not a commit without
+    asking Conduit.
+
+    The first sync pages through all the commits; the following ones only
+    fetch the commits which are newer than those already known."""
+    prefix_length = 7
+    page_size = 100
+    min_refresh_interval = 10
+
+    def __init__(self):
+        self._prefixes = set()
+        self._max_id = None
+        self._sync_lock = threading.Lock()
+        self._last_sync = None
+        self.synced = False
+
+    def may_contain(self, identifier):
+        """Returns False if the identifier is known not to be a prefix of
+        a commit hash."""
+        if not self.synced:
+            return True
+        return identifier[:self.prefix_length] in self._prefixes
+
+    def refresh(self, conduit):
+        """Fetches the commits pushed since the last sync, unless it was
+        less than min_refresh_interval seconds ago. Returns False if the
+        index may still be outdated, because another thread is syncing
+        it."""
+        if self._last_sync is not None and \
+                time.time() - self._last_sync < self.min_refresh_interval:
+            return True
+        return self.sync(conduit)
+
+    def sync(self, conduit):
+        """Returns False if another thread is already syncing it."""
+        if not self._sync_lock.acquire(blocking=False):
+            # Another thread is already syncing it
+            return False
+        try:
+            max_id = self._max_id
+            after = None
+            while True:
+                search_args = {'order': 'newest', 'limit': self.page_size}
+                if after:
+                    search_args['after'] = after
+                r = conduit.diffusion.commit.search(**search_args)
+                for commit in r['data']:
+                    if self._max_id is not None \
+                            and commit['id'] <= self._max_id:
+                        # Already known, and so are the older ones.
+                        after = None
+                        break
+                    identifier = commit['fields']['identifier']
+                    self._prefixes.add(identifier[:self.prefix_length])
+                    max_id = max(max_id or 0, commit['id'])
+                else:
+                    after = r['cursor']['after']
+                if not after:
+                    break
+            self._max_id = max_id
+            self._last_sync = time.time()
+            self.synced = True
+        finally:
+            self._sync_lock.release()
+        return True
+
+
+class RepositoryIndex:
+    """Repositories of a Phabricator instance, indexed by PHID, callsign
+    and short name.
+
+    Syncs only fetch the repositories created since the previous one,
+    except every full_sync_interval seconds, when the index is rebuilt
+    from all of them to forget the deleted and renamed ones."""
+    page_size = 100
+    full_sync_interval = 24 * 3600
+
+    def __init__(self):
+        self._by_phid = {}
+        self._by_callsign = {}
+        self._by_short_name = {}
+        self._max_id = None
+        self._last_full_sync = None
+        self._sync_lock = threading.Lock()
+
+    def add(self, repo):
+        old = self._by_phid.get(repo['phid'])
+        if old is not None:
+            # Forget its previous names, in case they changed.
+            for (by_name, field) in ((self._by_callsign, 'callsign'),
+                                     (self._by_short_name, 'shortName')):
+                name = old['fields'].get(field)
+                if name and by_name.get(name) is old:
+                    del by_name[name]
+        self._by_phid[repo['phid']] = repo
+        if repo['fields'].get('callsign'):
+            self._by_callsign[repo['fields']['callsign']] = repo
+        if repo['fields'].get('shortName'):
+            self._by_short_name[repo['fields']['shortName']] = repo
+
+    def get_by_phid(self, phid):
+        return self._by_phid.get(phid)
+
+    def get_by_callsign(self, callsign):
+        return self._by_callsign.get(callsign)
+
+    def get_by_short_name(self, short_name):
+        return self._by_short_name.get(short_name)
+
+    def sync(self, conduit):
+        if not self._sync_lock.acquire(blocking=False):
+            # Another thread is already syncing it
+            return
+        try:
+            full = self._last_full_sync is None or \
+                time.time() - self._last_full_sync >= self.full_sync_interval
+            repos = []
+            after = None
+            while True:
+                search_args = {'order': 'newest', 'limit': self.page_size}
+                if after:
+                    search_args['after'] = after
+                r = conduit.diffusion.repository.search(**search_args)
+                for repo in r['data']:
+                    if not full and self._max_id is not None \
+                            and repo['id'] <= self._max_id:
+                        # Already known, and so are the older ones.
+                        after = None
+                        break
+                    repos.append(repo)
+                else:
+                    after = r['cursor']['after']
+                if not after:
+                    break
+            if full:
+                # Rebuilt aside, so lookups are served until it is done.
+                index = RepositoryIndex()
+                for repo in reversed(repos):
+                    index.add(repo)
+                (self._by_phid, self._by_callsign, self._by_short_name) = \
+                    (index._by_phid, index._by_callsign, index._by_short_name)
+                self._last_full_sync = time.time()
+            else:
+                for repo in reversed(repos):
+                    self.add(repo)
+            self._max_id = max([self._max_id or 0] +
+                               [repo['id'] for repo in repos])
+        finally:
+            self._sync_lock.release()
+
+
+class FeedScheduler(threading.Thread):
+    """Long-lived thread polling the feeds of Phabricator instances.
+
+    Instances are kept in a priority queue of (next_due_time, host, token),
+    and polled one at a time by this thread, so there is never more than
+    one poll in flight for a given feed. Each poll is shared by all the
+    announcing channels using that instance."""
+    def __init__(self, plugin):
+        super().__init__(name='Phabricator feed scheduler', daemon=True)
+        self._plugin = plugin
+        self._queue = []
+        # Instances in the queue, which must not be added to it again
+        self._queued = set()
+        self._subscribers = {}
+        self._last_rescan = 0
+        self._rescan_requested = False
+        self._last_polls = {}
+        self._intervals = {}
+        self._pushes = set()
+        # Time of the last hook received for each network location
+        self._last_pushes = {}
+        self._pushes_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def wakeup(self):
+        """Makes the scheduler look for new announcing channels and run
+        the polls which are due, without waiting for its next tick."""
+        self._rescan_requested = True
+        self._wakeup.set()
+
+    def push(self, netloc):
+        """Makes the scheduler poll the instances at the given network
+        location as soon as possible, because their feed has new stories.
+        Until no hook was received for announce.push.fallbackInterval,
+        their feed is then only polled as a fallback.
+
+        Returns False if no announced instance is at this location."""
+        netlocs = {urllib.parse.urlparse(host).netloc
+                   for (host, _) in self._subscribers}
+        if netloc not in netlocs:
+            return False
+        with self._pushes_lock:
+            self._pushes.add(netloc)
+            self._last_pushes[netloc] = time.time()
+        self._wakeup.set()
+        return True
+
+    def clear_pushes(self):
+        """Forgets the hooks received so far, when they are disabled, and
+        polls the instances which sent them soon, then at the adaptive
+        interval again."""
+        with self._pushes_lock:
+            self._pushes.update(self._last_pushes)
+            self._last_pushes.clear()
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._schedule_pushes()
+            now = time.time()
+            rescan_interval = self._plugin.feed_rescan_interval
+            if self._rescan_requested \
+                    or self._last_rescan + rescan_interval <= now \
+                    or (self._queue and self._queue[0][0] <= now):
+                # Reset first, so a wakeup during the rescan is not lost.
+                self._rescan_requested = False
+                self._last_rescan = now
+                self._rescan()
+
+            while self._queue and self._queue[0][0] <= now \
+                    and not self._stopped.is_set():
+                self._poll(*self._pop())
+
+            next_wakeup = self._last_rescan + rescan_interval
+            if self._queue:
+                next_wakeup = min(next_wakeup, self._queue[0][0])
+            self._wakeup.wait(max(next_wakeup - time.time(), 0))
+            self._wakeup.clear()
+
+    def _schedule_pushes(self):
+        """Moves the pushed instances to the head of the queue, while
+        not polling any of them more than once per
+        feed_push_min_interval."""
+        with self._pushes_lock:
+            (pushes, self._pushes) = (self._pushes, set())
+        if not pushes:
+            return
+        queue = []
+        for (due, host, token) in self._queue:
+            if urllib.parse.urlparse(host).netloc in pushes:
+                due = min(due, max(time.time(),
+                    self._last_polls.get((host, token), 0)
+                    + self._plugin.feed_push_min_interval))
+            queue.append((due, host, token))
+        heapq.heapify(queue)
+        self._queue = queue
+
+    def _rescan(self):
+        """Lists the announcing channels of each instance, and adds to the
+        queue the instances that are not scheduled yet."""
+        self._plugin._update_feed_hook()
+        subscribers = defaultdict(list)
+        for irc in world.ircs:
+            for channel in irc.state.channels:
+                if self._plugin.registryValue('announce', channel):
+                    instance = self._plugin.instance(channel)
+                    subscribers[instance].append((irc, channel))
+        for instance in subscribers:
+            if instance not in self._queued:
+                self._queue_instance(time.time(), instance)
+        self._subscribers = dict(subscribers)
+
+    def _queue_instance(self, due, instance):
+        heapq.heappush(self._queue, (due,) + instance)
+        self._queued.add(instance)
+
+    def _pop(self):
+        """Removes the next instance to poll from the queue, and returns
+        its (host, token)."""
+        (_, host, token) = heapq.heappop(self._queue)
+        self._queued.discard((host, token))
+        return (host, token)
+
+    def _poll(self, host, token):
+        subscribers = self._subscribers.get((host, token))
+        if not subscribers:
+            # Not announced anymore, so dropped from the queue; _rescan
+            # will add it back if needed.
+            return
+
+        self._last_polls[host, token] = time.time()
+        try:
+            nb_stories = self._plugin._update_instance_feed(
+                host, token, subscribers)
+        except Exception:
+            self._plugin.log.exception(
+                'Error while updating the feed of %s', host)
+            nb_stories = 0
+
+        fallback_interval = self._plugin.registryValue(
+            'announce.push.fallbackInterval')
+        last_push = self._last_pushes.get(urllib.parse.urlparse(host).netloc)
+        if last_push is not None \
+                and time.time() - last_push < fallback_interval:
+            interval = fallback_interval
+        else:
+            interval = self._next_interval(host, token, subscribers,
+                                           nb_stories)
+        # Spread the polls of instances which would otherwise stay in
+        # lockstep.
+        interval *= 1 + random.uniform(0, self._plugin.feed_poll_jitter)
+        self._queue_instance(time.time() + interval, (host, token))
+
+    def _next_interval(self, host, token, subscribers, nb_stories):
+        """Returns the time to wait before polling the feed again: the
+        announce.interval as long as there are new stories, doubled after
+        each poll without any, up to announce.maxInterval."""
+        min_interval = min(
+            self._plugin.registryValue('announce.interval', channel)
+            for (irc, channel) in subscribers)
+        max_interval = max(min_interval, min(
+            self._plugin.registryValue('announce.maxInterval', channel)
+            for (irc, channel) in subscribers))
+        if nb_stories:
+            interval = min_interval
+        else:
+            interval = min(self._intervals.get((host, token), 0) * 2,
+                           max_interval)
+            interval = max(interval, min_interval)
+        self._intervals[host, token] = interval
+        return interval
+
+
+class FeedHookCallback(httpserver.SupyHTTPServerCallback):
+    """Receives the stories Phabricator posts to its feed.http-hooks, at
+    /phabricator/<host>, and has the feed of the instance polled right
+    away.
+
+    Hooks only tell the bot which feed has new stories: they are then
+    read through feed.query, like polled ones, so stories are announced
+    in order and exactly once, and cannot be forged."""
+    name = 'Phabricator'
+    defaultResponse = _("""This endpoint only supports POST requests.""")
+
+    def __init__(self, scheduler):
+        super().__init__()
+        self._scheduler = scheduler
+
+    def doPost(self, handler, path, form):
+        netloc = urllib.parse.unquote(path.strip('/'))
+        if not netloc or '/' in netloc:
+            response = b'Expected /phabricator/<host>\n'
+            handler.send_response(400)
+        elif not self._scheduler.push(netloc):
+            response = b'Unknown Phabricator instance\n'
+            handler.send_response(404)
+        else:
+            response = b''
+            handler.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+
+
 class Phabricator(callbacks.PluginRegexp):
     """Integration with the Phabricator development collaboration tools"""
     threaded = True
@@ -63,107 +639,410 @@ class Phabricator(callbacks.PluginRegexp):
         'phabricator_commit_from_regexp',
     ]
     phid_cache_expiry = 24 * 3600
+    phid_cache_revalidate_after = 300
+    feed_rescan_interval = 30
+    feed_page_size = 100
+    feed_push_min_interval = 2
+    feed_poll_jitter = 0.1
+    digest_max_authors = 4
+    digest_max_objects = 5
+    commit_negative_cache_expiry = 3600
+    unimported_commit_cache_expiry = 60
+    commit_index_sync_interval = 600
+    repository_sync_interval = 3600
+    interfaces_cache_expiry = 7 * 24 * 3600
+    interfaces_check_interval = 3600
+    warm_up_interval = 6 * 3600
+    warm_up_page_size = 100
+    reply_workers = 4
+    max_pending_replies = 20
 
     def __init__(self, irc):
         super().__init__(irc)
 
-        self.default_conduit = None
         self._conduits = {}
-        self._last_feed_announces = defaultdict(
-                lambda: feed_announce(0, None))
-        self._phid_object_cache = defaultdict(
-                lambda: cache_entry(None, 0))
-        self._phid_transaction_cache = defaultdict(
-                lambda: cache_entry(None, 0))
+        self._conduits_lock = threading.Lock()
+        self._feed_cursors = {}
+        self._saved_feed_cursors = {}
+        self._last_feed_announces = {}
+        self._load_feed_state()
+        cache_size = self.registryValue('cacheSize')
+        self._phid_object_cache = PhidCache(cache_size)
+        self._phid_transaction_cache = PhidCache(cache_size)
+        self._commit_negative_cache = PhidCache(cache_size)
+        self._reply_cache = PhidCache(cache_size)
+        self._recent_replies = PhidCache(cache_size)
+        self._commit_indexes = {}
+        self._repository_indexes = {}
+        self._warmed_up_instances = set()
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
+        # No more workers than pooled connections, so concurrent requests
+        # do not open throwaway connections.
+        self._transactions_executor = ThreadPoolExecutor(
+            max_workers=self.registryValue('conduit.poolSize'),
+            thread_name_prefix='Phabricator transactions')
+        self._reply_executor = ThreadPoolExecutor(
+            max_workers=self.reply_workers,
+            thread_name_prefix='Phabricator replies')
+        # Messages waiting for or being replied to by the executor
+        self._pending_replies = threading.BoundedSemaphore(
+            self.max_pending_replies)
         host = self.registryValue('phabricatorURI')
         token = self.registryValue('phabricatorConduitToken')
         if host and token:
-            self.default_conduit = self.conduit_for_host_token(host, token)
+            # Pre-warm the repository index of the default instance
+            self.repository_index(None)
+
+        self._persistent_cache = None
+        if self.registryValue('persistentCache'):
+            self._persistent_cache = PersistentCache(
+                conf.supybot.directories.data.dirize('Phabricator.sqlite'))
+
+        # Hooked by the scheduler, if announce.push is enabled.
+        self._feed_hook = None
+        self._feed_scheduler = FeedScheduler(self)
+        self._feed_scheduler.start()
+        schedule.addPeriodicEvent(self._sync_commit_indexes,
+                                  self.commit_index_sync_interval,
+                                  name='Phabricator commit indexes',
+                                  now=False)
+        schedule.addPeriodicEvent(self._sync_repository_indexes,
+                                  self.repository_sync_interval,
+                                  name='Phabricator repository indexes',
+                                  now=False)
+        schedule.addPeriodicEvent(self._warm_up,
+                                  self.warm_up_interval,
+                                  name='Phabricator warm-up',
+                                  now=False)
+        schedule.addPeriodicEvent(self._check_all_interfaces,
+                                  self.interfaces_check_interval,
+                                  name='Phabricator interfaces',
+                                  now=False)
+        self._warm_up()
+
+    def die(self):
+        self._feed_scheduler.stop()
+        # Let the current poll finish its Conduit call; if it still runs
+        # after that, it neither announces nor saves the feed state.
+        self._feed_scheduler.join(
+            timeout=max(10, self.registryValue('conduit.callTimeout')))
+        if self._feed_hook:
+            httpserver.unhook('phabricator')
+            self._feed_hook = None
+        schedule.removePeriodicEvent('Phabricator commit indexes')
+        schedule.removePeriodicEvent('Phabricator repository indexes')
+        schedule.removePeriodicEvent('Phabricator warm-up')
+        schedule.removePeriodicEvent('Phabricator interfaces')
+        self._transactions_executor.shutdown(wait=False)
+        self._reply_executor.shutdown(wait=False)
+        if self._persistent_cache:
+            self._persistent_cache.close()
+        for conduit in self._conduits.values():
+            conduit.close()
+        super().die()
+
+    def cachestats(self, irc, msg, args):
+        """takes no arguments
+
+        Returns the size and hit, miss and eviction counters of the caches
+        of Phabricator objects, transactions, unknown commits and
+        replies."""
+        stats = []
+        for (name, cache) in (('objects', self._phid_object_cache),
+                              ('transactions', self._phid_transaction_cache),
+                              ('unknown commits',
+                               self._commit_negative_cache),
+                              ('replies', self._reply_cache)):
+            stats.append(format('%s: %n, %n, %n, %n', name,
+                                (len(cache), 'entry'),
+                                (cache.hits, 'hit'),
+                                (cache.misses, 'miss'),
+                                (cache.evictions, 'eviction')))
+        irc.reply('; '.join(stats))
+    cachestats = wrap(cachestats)
+
+    def conduitstatus(self, irc, msg, args):
+        """takes no arguments
+
+        Returns the state of the connection to each Phabricator instance:
+        closed when it works, open when calls are rejected after too many
+        failures, and half-open when the next call will be tried."""
+        with self._conduits_lock:
+            conduits = list(self._conduits.values())
+        if not conduits:
+            irc.reply('No Phabricator instance was used yet.')
+            return
+        statuses = []
+        for conduit in conduits:
+            breaker = conduit.breaker
+            if breaker.state == 'open':
+                statuses.append(format('%s: open for %T, after %n',
+                    conduit.host,
+                    int(breaker.opened_at + breaker.cooldown - time.time()),
+                    (breaker.failures, 'failure')))
+            else:
+                statuses.append(format('%s: %s (%n)', conduit.host,
+                    breaker.state, (breaker.failures, 'failure')))
+        irc.reply('; '.join(statuses))
+    conduitstatus = wrap(conduitstatus)
+
+    def wrapped_lines(self, message):
+        line_length = 300
+        return ircutils.wrap(message, line_length)
 
     def wrapped_message(self, sender, message, **kwargs):
-        line_length = 300
-        wrapped = ircutils.wrap(message, line_length)
-        for msg in wrapped:
+        for msg in self.wrapped_lines(message):
             sender(msg, **kwargs)
 
-    def conduit_for_host_token(self, host, token):
-        if (host, token) in self._conduits:
-            return self._conduits[host, token]
+    @property
+    def default_conduit(self):
+        (host, token) = self.instance(None)
+        if host and token:
+            return self.conduit_for_host_token(host, token)
 
-        conduit = phabricator.Phabricator(
-            host=host,
-            token=token,
-        )
-        conduit.update_interfaces()
-        self._conduits[host, token] = conduit
+    def conduit_for_host_token(self, host, token):
+        with self._conduits_lock:
+            if (host, token) in self._conduits:
+                return self._conduits[host, token]
+
+            conduit = self._conduits[host, token] = Conduit(
+                host=host,
+                token=token,
+                pool_size=self.registryValue('conduit.poolSize'),
+                connect_timeout=self.registryValue('conduit.connectTimeout'),
+                read_timeout=self.registryValue('conduit.readTimeout'),
+                call_timeout=self.registryValue('conduit.callTimeout'),
+                failure_threshold=self.registryValue(
+                    'conduit.failureThreshold'),
+                cooldown=self.registryValue('conduit.cooldown'),
+            )
+        # Outside the lock, so other threads can get their conduits in the
+        # meantime. This one uses the default description until then.
+        self._load_interfaces(conduit)
         return conduit
 
-    def conduit(self, recipient):
+    def _interfaces_filename(self, host):
+        host = re.sub(r'[^a-zA-Z0-9.-]+', '_', host)
+        return conf.supybot.directories.data.dirize(
+            'Phabricator.interfaces.%s.json' % host)
+
+    def _load_interfaces(self, conduit):
+        """Loads the description of the Conduit methods of the host from the
+        disk, and refreshes it in the background if it is missing or expired.
+        Until then, the conduit uses the default description."""
+        filename = self._interfaces_filename(conduit.host)
+        try:
+            with open(filename) as fd:
+                cached = json.load(fd)
+            conduit.set_interfaces(cached['interfaces'],
+                                   float(cached['fetch_time']))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # Missing or malformed; fetched again below.
+            pass
+        self._check_interfaces(conduit)
+
+    def _check_interfaces(self, conduit):
+        """Refreshes the description of the Conduit methods of the host in
+        the background, if it was not fetched yet or is expired."""
+        fetch_time = conduit.interfaces_fetch_time
+        if fetch_time is None \
+                or fetch_time + self.interfaces_cache_expiry < time.time():
+            self._in_background('Phabricator interfaces refresh',
+                                self._refresh_interfaces, conduit,
+                                self._interfaces_filename(conduit.host))
+
+    def _check_all_interfaces(self):
+        with self._conduits_lock:
+            conduits = list(self._conduits.values())
+        for conduit in conduits:
+            self._check_interfaces(conduit)
+
+    def _refresh_interfaces(self, conduit, filename):
+        interfaces = conduit.fetch_interfaces()
+        conduit.set_interfaces(interfaces)
+        with utils.file.AtomicFile(filename, makeBackupIfSmaller=False) as fd:
+            json.dump({'fetch_time': conduit.interfaces_fetch_time,
+                       'interfaces': interfaces}, fd)
+
+    def instance(self, recipient):
+        """Returns the (host, token) pair identifying the Phabricator
+        instance used by the recipient."""
         host = self.registryValue(
             'phabricatorURI', channel=recipient
         )
         token = self.registryValue(
             'phabricatorConduitToken', channel=recipient
         )
-        return self.conduit_for_host_token(host, token)
+        return (host, token)
+
+    def conduit(self, recipient):
+        return self.conduit_for_host_token(*self.instance(recipient))
 
     def get_object_by_phid(self, recipient, phid,
                            skip_cache=False, object_fragment=None):
         objs = self.get_objects_by_phid(recipient, [phid], skip_cache)
         obj = objs.get(phid)
         if obj and object_fragment is not None:
-            url = obj['uri']
-            obj['uri'] = '%s%s' % (url, object_fragment)
+            # Copy it, as the object may be in the cache.
+            obj = obj._replace(uri=self.object_uri(obj, object_fragment))
         return obj
 
-    def get_objects_by_phid(self, recipient, phids, skip_cache=False):
+    def object_uri(self, obj, object_fragment=None):
+        if object_fragment is None:
+            return obj['uri']
+        return '%s%s' % (obj['uri'], object_fragment)
+
+    def _cache_get_many(self, cache, name, keys):
+        """Returns a dict mapping the given keys to their entries in the
+        cache, ignoring expired and missing entries. Entries missing from
+        memory are looked up in the persistent cache, if enabled."""
+        record_type = {
+            'object': ObjectRecord,
+            'transaction': TransactionRecord,
+        }[name]
+        found = {}
+        missing = []
+        for key in keys:
+            entry = cache.get(key)
+            if entry is None:
+                missing.append(key)
+            else:
+                found[key] = entry
+        if missing and self._persistent_cache:
+            keys = {self._persistent_key(key): key for key in missing}
+            for (persistent_key, entry) in self._persistent_cache.get_many(
+                    name, list(keys)).items():
+                key = keys[persistent_key]
+                entry = entry._replace(
+                        data=record_type.from_json(entry.data))
+                cache.set(key, entry)
+                found[key] = entry
+        return found
+
+    def _cache_set(self, cache, name, key, data):
+        entry = cache_entry(data, time.time() + self.phid_cache_expiry)
+        cache.set(key, entry)
+        if self._persistent_cache:
+            self._persistent_cache.set(name, self._persistent_key(key),
+                                       entry)
+
+    @staticmethod
+    def _persistent_key(key):
+        """Returns the key of an entry in the persistent cache: the
+        in-memory keys start with the (host, token) pair of the instance,
+        but only the host is written to the disk."""
+        ((host, _), *rest) = key
+        return (host, *rest)
+
+    def _is_stale(self, entry):
+        """Returns whether the entry was fetched more than
+        phid_cache_revalidate_after seconds ago."""
+        fetch_time = entry.expiry - self.phid_cache_expiry
+        return fetch_time + self.phid_cache_revalidate_after <= time.time()
+
+    def get_objects_by_phid(self, recipient, phids, skip_cache=False,
+                            revalidate=False):
+        """Returns a dict mapping the PHIDs to their objects.
+
+        If revalidate is True, stale objects are still returned from the
+        cache, but are refreshed in the background for the next calls."""
+        # Cache by instance, so channels sharing a Phabricator instance
+        # also share its cache.
+        instance = self.instance(recipient)
         objects = {}
+        stale = []
         if not skip_cache:
-            for phid in phids:
-                obj, timeout = self._phid_object_cache[recipient, phid]
-                if timeout > time.time():
-                    objects[phid] = obj
+            cached = self._cache_get_many(self._phid_object_cache, 'object',
+                    [(instance, phid) for phid in phids])
+            for ((_, phid), entry) in cached.items():
+                objects[phid] = entry.data
+                if revalidate and self._is_stale(entry):
+                    stale.append(phid)
         if set(objects) == set(phids):
             # If we already got all the phids we need in the cache,
             # no need to make a query
+            if stale:
+                self._revalidate_objects(recipient, instance, stale)
             return objects
 
         # Else, make a single request for all the objects
         # (even those in the cache; there's no harm in refreshing them)
+        return self._query_objects(recipient, instance, phids)
+
+    def _revalidate_objects(self, recipient, instance, phids):
+        """Refreshes the cached objects in the background, unless they are
+        already being refreshed."""
+        with self._revalidating_lock:
+            phids = [phid for phid in phids
+                     if (instance, phid) not in self._revalidating]
+            self._revalidating.update((instance, phid) for phid in phids)
+        if not phids:
+            return
+
+        def refresh():
+            try:
+                self._query_objects(recipient, instance, phids)
+            finally:
+                with self._revalidating_lock:
+                    self._revalidating.difference_update(
+                            (instance, phid) for phid in phids)
+        self._in_background('Phabricator objects refresh', refresh)
+
+    def _query_objects(self, recipient, instance, phids):
         r = self.conduit(recipient).phid.query(phids=phids)
+        objects = {}
         for (phid, obj) in r.items():
-            self._phid_object_cache[recipient, phid] = cache_entry(
-                obj,
-                time.time() + self.phid_cache_expiry
-            )
-        return dict(r)
+            obj = ObjectRecord.from_conduit(obj)
+            self._cache_set(self._phid_object_cache, 'object',
+                    (instance, phid), obj)
+            objects[phid] = obj
+        return objects
 
     def get_transactions_by_phid(self, recipient, transactions_phids,
             object_phid, skip_cache=False):
+        """Returns a dict mapping the PHIDs of the given transactions of an
+        object to the transactions, newest first, as Conduit sorts them.
+        Transactions which do not exist are missing from the dict."""
+        instance = self.instance(recipient)
         transactions = {}
         if not skip_cache:
-            for phid in transactions_phids:
-                trans, timeout = self._phid_transaction_cache[recipient,
-                        object_phid, phid]
-                if timeout > time.time():
-                    transactions[phid] = trans
+            cached = self._cache_get_many(self._phid_transaction_cache,
+                    'transaction',
+                    [(instance, object_phid, phid)
+                     for phid in transactions_phids])
+            for ((_, _, phid), entry) in cached.items():
+                transactions[phid] = entry.data
         if set(transactions) == set(transactions_phids):
             # If we already got all the phids we need in the cache,
             # no need to make a query
-            return transactions
+            return self._sorted_transactions(transactions)
 
         # Else, make a single request for all the transactions
-        # (even those in the cache; there's no harm in refreshing them)
-        r = self.conduit(recipient).transaction.search(
-                objectIdentifier=object_phid,
-                constraints={'phids': transactions_phids})
-        for trans in r['data']:
-            self._phid_transaction_cache[recipient, object_phid, trans['phid']] = cache_entry(
-                trans,
-                time.time() + self.phid_cache_expiry
-            )
+        # (even those in the cache; there's no harm in refreshing them),
+        # paging through the results if there are many of them.
+        conduit = self.conduit(recipient)
+        data = []
+        paging = {}
+        while True:
+            r = conduit.transaction.search(
+                    objectIdentifier=object_phid,
+                    constraints={'phids': transactions_phids},
+                    **paging)
+            data.extend(r['data'])
+            if not r['cursor']['after']:
+                break
+            paging = {'after': r['cursor']['after']}
+        for trans in map(TransactionRecord.from_conduit, data):
+            self._cache_set(self._phid_transaction_cache, 'transaction',
+                    (instance, object_phid, trans['phid']), trans)
             transactions[trans['phid']] = trans
-        return dict(r)
+        return self._sorted_transactions(transactions)
+
+    @staticmethod
+    def _sorted_transactions(transactions):
+        return dict(sorted(transactions.items(),
+                key=lambda item: item[1]['id'], reverse=True))
 
     def get_commit_author_info(self, recipient, commit, type='author'):
         if not commit['%sPHID' % type]:
@@ -175,28 +1054,74 @@ class Phabricator(callbacks.PluginRegexp):
         return author['name']
 
     def get_repo(self, recipient, repo):
+        return self._get_repo_by(recipient, 'phids', repo)
+
+    def get_repo_by_callsign(self, recipient, callsign):
+        return self._get_repo_by(recipient, 'callsigns', callsign)
+
+    def _get_repo_by(self, recipient, constraint, value):
+        """Returns a repository from the instance's repository index, or
+        from Conduit if it is not indexed yet."""
+        index = self.repository_index(recipient)
+        getter = {
+            'phids': index.get_by_phid,
+            'callsigns': index.get_by_callsign,
+        }
+        repo = getter[constraint](value)
+        if repo is not None:
+            return repo
+
         conduit = self.conduit(recipient)
         res = conduit.diffusion.repository.search(
-            constraints={'phids': [repo]}
+            constraints={constraint: [value]}
         )
         if res.response['data']:
-            return res.response['data'][0]
+            repo = res.response['data'][0]
+            index.add(repo)
+            return repo
+
+    def repository_index(self, recipient):
+        """Returns the repository index of the recipient's instance; it is
+        filled in the background on first use."""
+        instance = self.instance(recipient)
+        if instance not in self._repository_indexes:
+            index = self._repository_indexes.setdefault(
+                    instance, RepositoryIndex())
+            self._in_background('Phabricator repository index sync',
+                                self._sync_index, instance, index)
+        return self._repository_indexes[instance]
 
     def get_buildable(self, recipient, phid):
-        conduit = self.conduit(recipient)
-        res = conduit.harbormaster.querybuildables(phids=[phid])
-        if not res.response['data']:
+        data = self.query_buildable(recipient, phid)
+        if data is None:
             return
+        objects = self.get_objects_by_phid(recipient,
+                                           self.buildable_phids(data))
+        return self.resolve_buildable(data, objects)
+
+    def query_buildable(self, recipient, phid):
+        return self.query_buildables(recipient, [phid]).get(phid)
+
+    def query_buildables(self, recipient, phids):
+        """Returns a dict mapping the PHIDs to the buildables found, with a
+        single call."""
+        if not phids:
+            return {}
+        conduit = self.conduit(recipient)
+        res = conduit.harbormaster.querybuildables(phids=list(set(phids)))
+        return {data['phid']: data.copy() for data in res.response['data']}
+
+    def buildable_phids(self, data):
+        """Returns the PHIDs resolve_buildable needs the objects of."""
+        return [phid for phid in (data['buildablePHID'],
+                                  data['containerPHID'])
+                if phid]
 
-        data = res.response['data'][0].copy()
-        buildable = self.get_object_by_phid(recipient,
-                                            data['buildablePHID'])
+    def resolve_buildable(self, data, objects):
+        buildable = objects[data['buildablePHID']]
         data['buildable'] = buildable
         if buildable['type'] == 'DIFF':
-            buildable = self.get_object_by_phid(recipient,
-                                                data['containerPHID'])
-            data['buildable'] = buildable
-
+            data['buildable'] = objects[data['containerPHID']]
         return data
 
     def get_repo_name(self, repo):
@@ -233,52 +1158,226 @@ class Phabricator(callbacks.PluginRegexp):
          |\b        # word boundary
         )
         """
-        for recipient in msg.args[0].split(','):
+        # Only collect the references; doPrivmsg looks them all up at
+        # once when all the regexps ran on the message.
+        references = msg.tagged('phabricatorObjectReferences')
+        if references is not None:
+            references.append(match)
+
+    def doPrivmsg(self, irc, msg):
+        msg.tag('phabricatorObjectReferences', [])
+        msg.tag('phabricatorCommitReferences', [])
+        super().doPrivmsg(irc, msg)
+        references = msg.tagged('phabricatorObjectReferences')
+        commits = msg.tagged('phabricatorCommitReferences')
+        if not (references or commits):
+            return
+        # Conduit calls may take up to conduit.callTimeout seconds; do not
+        # block the driver thread while they are sent, nor let messages
+        # pile up while an instance is slow.
+        if not self._pending_replies.acquire(blocking=False):
+            self.log.warning('Phabricator: too many pending replies, '
+                             'ignoring %r from %s.', msg.args[1], msg.prefix)
+            return
+        try:
+            self._reply_executor.submit(self._reply, self.Proxy(irc, msg),
+                                        msg, references, commits)
+        except RuntimeError:
+            # Shut down by die()
+            self._pending_replies.release()
+
+    def _reply(self, irc, msg, references, commits):
+        try:
+            self._reply_to_references(irc, msg, references, commits)
+        finally:
+            self._pending_replies.release()
+
+    def _reply_to_references(self, irc, msg, references, commits):
+        replies = []
+        if references:
+            replies.append((self.reply_with_objects, references))
+        replies.extend((self.reply_with_commit, match) for match in commits)
+        for (f, arg) in replies:
+            try:
+                f(irc, msg, arg)
+            except callbacks.Error as e:
+                irc.error(str(e))
+            except Exception:
+                self.log.exception('Uncaught exception in %s:', f.__name__)
+
+    def reply_with_objects(self, irc, msg, matches):
+        """Replies with the objects referenced by the matches of
+        phabricator_object_from_regexp, making a single search call per
+        object type and a single PHID lookup for all of them."""
+        formatter = {
+            'B': self.build_formatter,
+            'D': self.diff_formatter,
+            'P': self.paste_formatter,
+            'T': self.task_formatter,
+        }
+
+        references = []
+        for match in matches:
             object_type = match.group(1).upper()
-            lookup = {
-                'B': self.conduit(recipient).harbormaster.build.search,
-                'D': self.conduit(recipient).differential.revision.search,
-                'P': self.conduit(recipient).paste.search,
-                'T': self.conduit(recipient).maniphest.search,
-            }
-            if object_type not in lookup:
-                return
-
+            if object_type not in formatter:
+                continue
             object_id = int(match.group(2))
             object_fragment = match.group(3)  # Or None as this is optional
+            if (object_type, object_id, object_fragment) not in references:
+                references.append((object_type, object_id, object_fragment))
+        if not references:
+            return
 
+        for recipient in msg.args[0].split(','):
+            instance = self.instance(recipient)
+            found = self.search_objects(recipient, references)
+
+            # Reuse the replies rendered since the objects were last
+            # modified, and only render the other ones.
+            replies = {}
+            for (object_type, object_id, object_fragment) in references:
+                object = found.get((object_type, object_id))
+                if object is None:
+                    continue
+                entry = self._reply_cache.get(
+                    (instance, object_type, object_id, object_fragment))
+                if entry is not None and \
+                        entry.data[0] == self.date_modified(object):
+                    replies[object_type, object_id, object_fragment] = \
+                            entry.data[1]
+            missing = [reference for reference in references
+                       if reference[:2] in found
+                       and reference not in replies]
+            if missing:
+                # Builds also need their buildables, fetched all at once.
+                buildables = self.query_buildables(recipient, [
+                    found[object_type, object_id]['fields']['buildablePHID']
+                    for (object_type, object_id, _) in missing
+                    if object_type == 'B'])
+                phids = []
+                for (object_type, object_id, _) in missing:
+                    object = found[object_type, object_id]
+                    phids.extend(self.object_phids(object_type, object))
+                    if object_type == 'B':
+                        buildable = buildables.get(
+                            object['fields']['buildablePHID'])
+                        if buildable is not None:
+                            phids.extend(self.buildable_phids(buildable))
+                objects = self.get_objects_by_phid(recipient, phids,
+                                                   revalidate=True)
+                for (object_type, object_id, object_fragment) in missing:
+                    object = found[object_type, object_id]
+                    extra = {'buildables': buildables} \
+                        if object_type == 'B' else {}
+                    # Do not let a broken object prevent the other
+                    # replies.
+                    try:
+                        text = formatter[object_type](
+                            recipient, object, object_fragment, objects,
+                            **extra)
+                    except callbacks.Error as e:
+                        irc.error(str(e))
+                        continue
+                    except Exception:
+                        self.log.exception('Could not format %s%s:',
+                                           object_type, object_id)
+                        continue
+                    if text is None:
+                        continue
+                    lines = self.wrapped_lines(text)
+                    replies[object_type, object_id, object_fragment] = lines
+                    if self.date_modified(object) is not None:
+                        self._reply_cache.set(
+                            (instance, object_type, object_id,
+                             object_fragment),
+                            cache_entry((self.date_modified(object), lines),
+                                        time.time() + self.phid_cache_expiry))
+
+            cooldown = self.registryValue('replyCooldown', recipient)
+            for reference in references:
+                lines = replies.get(reference)
+                if lines is None:
+                    continue
+                if cooldown:
+                    # Don't repeat the same reply during the cooldown.
+                    key = (irc.network, recipient, instance) + reference
+                    entry = self._recent_replies.get(key)
+                    if entry is not None and entry.data == lines:
+                        continue
+                    self._recent_replies.set(
+                        key, cache_entry(lines, time.time() + cooldown))
+                for line in lines:
+                    irc.reply(line, notice=True, prefixNick=False,
+                              to=recipient)
+
+    @staticmethod
+    def date_modified(object):
+        return object['fields'].get('dateModified')
+
+    def search_objects(self, recipient, references):
+        """Returns a dict mapping (object_type, object_id) to the objects
+        matching the references, with one search call per object type."""
+        conduit = self.conduit(recipient)
+        lookup = {
+            'B': lambda: conduit.harbormaster.build.search,
+            'D': lambda: conduit.differential.revision.search,
+            'P': lambda: conduit.paste.search,
+            'T': lambda: conduit.maniphest.search,
+        }
+        ids = defaultdict(list)
+        for (object_type, object_id, _) in references:
+            if object_id not in ids[object_type]:
+                ids[object_type].append(object_id)
+
+        found = {}
+        for (object_type, object_ids) in ids.items():
             lookup_args = {
                 'constraints': {
-                    'ids': [object_id],
+                    'ids': object_ids,
                 },
             }
-
-            query = lookup[object_type](**lookup_args)
-            r = query.response
-            if not r['data']:
-                return
-
-            object = r['data'][0]
-
-            formatter = {
-                'B': self.build_formatter,
-                'D': self.diff_formatter,
-                'P': self.paste_formatter,
-                'T': self.task_formatter,
-            }
-
-            self.wrapped_message(
-                irc.reply,
-                formatter[object_type](recipient, object, object_fragment),
-                notice=True,
-                prefixNick=False,
-                to=recipient,
-            )
-
-    def build_formatter(self, recipient, build, object_fragment=None):
-        full_build = self.get_object_by_phid(recipient, build['phid'], True)
-        buildable = self.get_buildable(recipient,
-                                       build['fields']['buildablePHID'])
+            query = lookup[object_type]()(**lookup_args)
+            for object in query.response['data']:
+                found[object_type, object['id']] = object
+        return found
+
+    def object_phids(self, object_type, object):
+        """Returns the PHIDs the formatter of the object needs to fetch."""
+        fields = object['fields']
+        if object_type == 'T':
+            return [object['phid'], fields['authorPHID']] + \
+                    ([fields['ownerPHID']] if fields['ownerPHID'] else [])
+        elif object_type in ('D', 'P'):
+            return [object['phid'], fields['authorPHID']]
+        else:
+            return [object['phid']]
+
+    def resolve_phids(self, recipient, phids, objects=None):
+        """Returns a dict with the objects of the PHIDs, only fetching
+        those which are not in the given objects already."""
+        objects = dict(objects or {})
+        missing = [phid for phid in phids if phid not in objects]
+        if missing:
+            objects.update(self.get_objects_by_phid(recipient, missing,
+                                                    revalidate=True))
+        return objects
+
+    def build_formatter(self, recipient, build, object_fragment=None,
+                        objects=None, buildables=None):
+        """Returns None if the buildable of the build is not found."""
+        buildable_phid = build['fields']['buildablePHID']
+        if buildables is None:
+            buildables = self.query_buildables(recipient, [buildable_phid])
+        buildable = buildables.get(buildable_phid)
+        if buildable is None:
+            return None
+        # Copied, as resolve_buildable adds the objects to it.
+        buildable = dict(buildable)
+        objects = self.resolve_phids(
+            recipient, [build['phid']] + self.buildable_phids(buildable),
+            objects)
+        full_build = objects[build['phid']]
+        buildable = self.resolve_buildable(buildable, objects)
         details = []
         status = build['fields']['buildStatus']['name']
         details.append('status: %s' % self.build_status_theme(status))
@@ -291,15 +1390,15 @@ class Phabricator(callbacks.PluginRegexp):
             url=full_build['uri'],
         )
 
-    def diff_formatter(self, recipient, diff, object_fragment=None):
-        full_diff = self.get_object_by_phid(recipient, diff['phid'], True,
-                                            object_fragment=object_fragment)
+    def diff_formatter(self, recipient, diff, object_fragment=None,
+                       objects=None):
+        objects = self.resolve_phids(
+            recipient, self.object_phids('D', diff), objects)
+        full_diff = objects[diff['phid']]
         repo = self.get_repo(recipient, diff['fields']['repositoryPHID'])
         details = []
         details.append(
-            'author: %s' % self.get_user_by_phid(
-                recipient, diff['fields']['authorPHID']
-            )
+            'author: %s' % objects[diff['fields']['authorPHID']]['name']
         )
         status = diff['fields']['status']['name']
         details.append(self.diff_status_theme(status))
@@ -309,40 +1408,38 @@ class Phabricator(callbacks.PluginRegexp):
             repo=ircutils.bold(self.get_repo_name(repo)),
             title=diff['fields']['title'],
             details=', '.join(details),
-            url=full_diff['uri'],
+            url=self.object_uri(full_diff, object_fragment),
         )
 
-    def paste_formatter(self, recipient, paste, object_fragment=None):
-        full_paste = self.get_object_by_phid(recipient, paste['phid'], True,
-                                             object_fragment=object_fragment)
+    def paste_formatter(self, recipient, paste, object_fragment=None,
+                        objects=None):
+        objects = self.resolve_phids(
+            recipient, self.object_phids('P', paste), objects)
+        full_paste = objects[paste['phid']]
         details = []
         details.append(
-            'author: %s' % self.get_user_by_phid(
-                recipient, paste['fields']['authorPHID']
-            )
+            'author: %s' % objects[paste['fields']['authorPHID']]['name']
         )
 
         return "{id} ({details}): {title} <{url}>".format(
             id=ircutils.bold('P%s' % paste['id']),
             title=paste['fields']['title'],
             details=', '.join(details),
-            url=full_paste['uri'],
+            url=self.object_uri(full_paste, object_fragment),
         )
 
-    def task_formatter(self, recipient, task, object_fragment=None):
-        full_task = self.get_object_by_phid(recipient, task['phid'], True,
-                                            object_fragment=object_fragment)
+    def task_formatter(self, recipient, task, object_fragment=None,
+                       objects=None):
+        objects = self.resolve_phids(
+            recipient, self.object_phids('T', task), objects)
+        full_task = objects[task['phid']]
         details = []
         details.append(
-            'submitter: %s' % self.get_user_by_phid(
-                recipient, task['fields']['authorPHID']
-            )
+            'submitter: %s' % objects[task['fields']['authorPHID']]['name']
         )
         if task['fields']['ownerPHID']:
             details.append(
-                'owner: %s' % self.get_user_by_phid(
-                    recipient, task['fields']['ownerPHID']
-                )
+                'owner: %s' % objects[task['fields']['ownerPHID']]['name']
             )
         priority = task['fields']['priority']['name']
         if priority != 'Normal':
@@ -354,7 +1451,7 @@ class Phabricator(callbacks.PluginRegexp):
             id=ircutils.bold('T%s' % task['id']),
             title=task['fields']['name'],
             details=', '.join(details),
-            url=full_task['uri'],
+            url=self.object_uri(full_task, object_fragment),
         )
 
     def commit_formatter(self, recipient, commit, skip_details=None):
@@ -363,6 +1460,12 @@ class Phabricator(callbacks.PluginRegexp):
 
         details = []
         if 'author' not in skip_details:
+            # Fetch both users at once, get_commit_author_info will then
+            # find them in the cache.
+            phids = [commit[field] for field in ('authorPHID', 'committerPHID')
+                     if commit[field]]
+            if phids:
+                self.get_objects_by_phid(recipient, phids)
             author_info = self.get_commit_author_info(recipient, commit,
                                                       'author')
             details.append("author: %s" % author_info)
@@ -401,6 +1504,14 @@ class Phabricator(callbacks.PluginRegexp):
          |\b         # word boundary
         )
         """
+        # Only collect the references, like phabricator_object_from_regexp
+        commits = msg.tagged('phabricatorCommitReferences')
+        if commits is not None:
+            commits.append(match)
+
+    def reply_with_commit(self, irc, msg, match):
+        """Replies with the commit referenced by a match of
+        phabricator_commit_from_regexp."""
         for recipient in msg.args[0].split(','):
             commit_id = match.group(2)
             repo_id = match.group(1)
@@ -408,17 +1519,31 @@ class Phabricator(callbacks.PluginRegexp):
                 'names': [commit_id],
             }
 
+            # Most hexadecimal words are not commits; avoid asking Conduit
+            # about them again and again.
+            negative_key = (self.instance(recipient), repo_id, commit_id)
+            if self._commit_negative_cache.get(negative_key):
+                return
+            index = self.commit_index(recipient)
+            if index is not None and not index.may_contain(commit_id):
+                # It may have been pushed since the last sync of the index
+                if index.refresh(self.conduit(recipient)) \
+                        and not index.may_contain(commit_id):
+                    return
+
             if repo_id:
-                r = self.conduit(recipient).diffusion.repository.search(
-                    constraints={'callsigns': [repo_id[1:]]},
-                )
-                if not r.response['data']:
+                repo = self.get_repo_by_callsign(recipient, repo_id[1:])
+                if not repo:
+                    self._cache_unknown_commit(negative_key)
                     return
-                repo_phid = r.response['data'][0]['phid']
-                query_params['repositoryPHID'] = repo_phid
+                query_params['repositoryPHID'] = repo['phid']
 
             r = self.conduit(recipient).diffusion.querycommits(**query_params)
             if not r.response['identifierMap']:
+                # Commits are imported asynchronously, so it may show up
+                # soon.
+                self._cache_unknown_commit(
+                    negative_key, self.unimported_commit_cache_expiry)
                 return
 
             commit_phid = r.response['identifierMap'][commit_id]
@@ -432,62 +1557,348 @@ class Phabricator(callbacks.PluginRegexp):
                 to=recipient,
             )
 
-    def __call__(self, irc, msg):
-        super().__call__(irc, msg)
-        threading.Thread(target=self._update_feeds).start()
-
-    def _update_feeds(self):
-        """Goes through all channels, and trigger an update on the ones
-        which have an associated feed."""
-        for irc in world.ircs:
-            for channel in irc.state.channels:
-                if self.registryValue('announce', channel):
-                    self._update_feed_if_needed(irc, channel)
-
-    def _update_feed_if_needed(self, irc, channel):
-        """Triggers an update if the channel's feed should be updated."""
-        recipient_key = (irc.network, channel)
-        previous_announce = self._last_feed_announces[recipient_key]
-        current_time = time.time()
-        interval = self.registryValue('announce.interval', channel)
-        if previous_announce.fetch_time + interval < current_time:
-            max_epoch = self._update_feed(irc, channel,
-                    previous_announce.max_epoch)
-            self._last_feed_announces[recipient_key] = feed_announce(
-                    fetch_time=current_time,
-                    max_epoch=max_epoch)
-
-    def _update_feed(self, irc, channel, after_epoch):
-        """Send updates of a feed to a channel, and returns its max epoch."""
-        conduit = self.conduit(channel)
-        stories = conduit.feed.query(view='data')
-
-        stories = sorted(stories.values(),
-                key=operator.itemgetter('epoch'))
-
-        objects = self.get_objects_by_phid(channel,
+    def _cache_unknown_commit(self, key, expiry=None):
+        if expiry is None:
+            expiry = self.commit_negative_cache_expiry
+        self._commit_negative_cache.set(key, cache_entry(
+            True, time.time() + expiry))
+
+    def commit_index(self, recipient):
+        """Returns the commit index of the recipient's instance, or None if
+        it is disabled. The index is synced in the background, and used as
+        soon as its first sync is over."""
+        if not self.registryValue('commitIndex'):
+            return None
+        instance = self.instance(recipient)
+        if instance not in self._commit_indexes:
+            index = self._commit_indexes.setdefault(instance, CommitIndex())
+            self._in_background('Phabricator commit index sync',
+                                self._sync_index, instance, index)
+        return self._commit_indexes[instance]
+
+    def _sync_commit_indexes(self):
+        for (instance, index) in list(self._commit_indexes.items()):
+            self._in_background('Phabricator commit index sync',
+                                self._sync_index, instance, index)
+
+    def _sync_repository_indexes(self):
+        for (instance, index) in list(self._repository_indexes.items()):
+            self._in_background('Phabricator repository index sync',
+                                self._sync_index, instance, index)
+
+    def _warm_up(self, channels=None):
+        """Fills the caches of the instances used by the bot (or by the
+        given channels) with all their users and repositories, if warmUp
+        is enabled."""
+        if not self.registryValue('warmUp'):
+            return
+        if channels is None:
+            instances = {self.instance(None)}
+            for irc in world.ircs:
+                for channel in irc.state.channels:
+                    instances.add(self.instance(channel))
+        else:
+            # Only the instances which were not warmed up yet
+            instances = {self.instance(channel) for channel in channels}
+            instances -= self._warmed_up_instances
+        instances = [(host, token) for (host, token) in instances
+                     if host and token]
+        self._warmed_up_instances.update(instances)
+        if instances:
+            self._in_background('Phabricator warm-up',
+                                self._warm_up_instances, instances)
+
+    def _warm_up_instances(self, instances):
+        for instance in instances:
+            self._warm_up_users(instance)
+            index = self._repository_indexes.setdefault(
+                    instance, RepositoryIndex())
+            self._sync_index(instance, index)
+
+    def _warm_up_users(self, instance):
+        """Pages through all the users of the instance, and adds them to
+        the object cache, as phid.query would return them."""
+        (host, _) = instance
+        conduit = self.conduit_for_host_token(*instance)
+        after = None
+        while True:
+            search_args = {'limit': self.warm_up_page_size}
+            if after:
+                search_args['after'] = after
+            r = conduit.user.search(**search_args)
+            for user in r['data']:
+                self._cache_set(self._phid_object_cache, 'object',
+                        (instance, user['phid']),
+                        ObjectRecord.from_user_search(user, host))
+            after = r['cursor']['after']
+            if not after:
+                break
+
+    def _sync_index(self, instance, index):
+        index.sync(self.conduit_for_host_token(*instance))
+
+    def _in_background(self, name, f, *args):
+        """Runs f(*args) in a new thread, logging its exceptions."""
+        def run():
+            try:
+                f(*args)
+            except Exception:
+                self.log.exception('Uncaught exception in %s:', name)
+        threading.Thread(target=run, name=name, daemon=True).start()
+
+    def _update_feed_hook(self):
+        """Hooks or unhooks the HTTP endpoint receiving the feed hooks,
+        depending on announce.push."""
+        if self.registryValue('announce.push'):
+            if self._feed_hook is None:
+                self._feed_hook = FeedHookCallback(self._feed_scheduler)
+                httpserver.hook('phabricator', self._feed_hook)
+        elif self._feed_hook is not None:
+            # Poll the feeds adaptively again.
+            self._feed_scheduler.clear_pushes()
+            httpserver.unhook('phabricator')
+            self._feed_hook = None
+
+    def doJoin(self, irc, msg):
+        if ircutils.strEqual(msg.nick, irc.nick):
+            self._feed_scheduler.wakeup()
+            self._warm_up(msg.args[0].split(','))
+
+    def _update_instance_feed(self, host, token, subscribers):
+        """Fetches the new stories of an instance's feed, announces
+        them to the subscribed (irc, channel) pairs, and returns how many
+        there were."""
+        instance = (host, token)
+        conduit = self.conduit_for_host_token(host, token)
+        after_key = self._feed_cursors.get(instance)
+        if after_key is None:
+            after_key = self._saved_feed_cursors.get(host)
+            if after_key is not None and \
+                    self.registryValue('announce.backlog'):
+                # Catch up with the stories since the bot was stopped.
+                stories = self._fetch_backlog(conduit, host, after_key)
+                self._feed_cursors[instance] = after_key
+            else:
+                # Don't announce on the first run, only look for the
+                # cursor to start from.
+                after_key = None
+                stories = []
+                newest = self._sorted_stories(
+                        conduit.feed.query(view='data', limit=1))
+                if newest:
+                    self._feed_cursors[instance] = \
+                            newest[-1]['chronologicalKey']
+                    self._save_feed_state()
+        else:
+            stories = self._fetch_stories_after(conduit, after_key)
+
+        # Channels which just subscribed only get the stories which are
+        # newer than the ones the instance already announced.
+        watermarks = {}
+        for (irc, channel) in subscribers:
+            key = (irc.network, channel)
+            watermarks[key] = self._last_feed_announces.get(key, after_key)
+        if stories:
+            self._announce_stories(subscribers, stories, watermarks)
+            self._feed_cursors[instance] = stories[-1]['chronologicalKey']
+
+        # Only move the watermarks once the stories are announced, so
+        # they are not lost if that fails.
+        cursor = self._feed_cursors.get(instance)
+        if cursor is not None:
+            for key in watermarks:
+                self._last_feed_announces[key] = cursor
+            if stories or any(watermarks[key] != cursor
+                              for key in watermarks):
+                self._save_feed_state()
+        return len(stories)
+
+    def _announce_stories(self, subscribers, stories, watermarks):
+        """Announces the stories to the subscribed (irc, channel) pairs
+        which did not see them yet, according to their watermarks."""
+        # All subscribers share the same conduit, so any of them can be
+        # used to resolve the stories.
+        (_, recipient) = subscribers[0]
+        objects = self.get_objects_by_phid(recipient,
                 [story['data']['objectPHID'] for story in stories])
+        transactions = self._stories_transactions(recipient, stories)
+        authors = self.get_objects_by_phid(recipient, list({
+            trans['authorPHID']
+            for story_transactions in transactions
+            for trans in story_transactions}))
+
+        announces = [
+            (story['chronologicalKey'],
+             self._story_actions(story_transactions, authors),
+             objects[story['data']['objectPHID']])
+            for (story, story_transactions) in zip(stories, transactions)]
+
+        for (irc, channel) in subscribers:
+            if self._feed_scheduler.stopped:
+                # Unloaded while fetching the stories
+                return
+            watermark = watermarks[irc.network, channel]
+            if watermark is None:
+                continue
+            new_announces = [(actions, obj)
+                             for (key, actions, obj) in announces
+                             if int(key) > int(watermark)]
+            threshold = self.registryValue('announce.digestThreshold',
+                                           channel)
+            if threshold and len(new_announces) > threshold:
+                self._announce_digest(irc, channel, new_announces)
+                continue
+            for (actions, obj) in new_announces:
+                self._announce_story(irc, channel, actions, obj)
 
-        after_epoch = after_epoch or 0
-        for story in stories:
-            if (after_epoch > 0 and # Don't announce on the first run
-                    story['epoch'] > after_epoch):
-                self._announce_story(irc, channel, story,
-                        objects[story['data']['objectPHID']])
-        max_epoch = max(story['epoch'] for story in stories)
-        return max(after_epoch, max_epoch)
-
-    def _announce_story(self, irc, channel, story, obj):
-        """Send a story to a channel."""
+    def _announce_digest(self, irc, channel, announces):
+        """Send a summary of many stories to a channel, with a line per
+        author, instead of a line per story."""
         username_blacklist = self.registryValue('announce.usernameBlacklist',
                     channel)
-        transactions = self.get_transactions_by_phid(channel,
-                list(story['data']['transactionPHIDs']), obj['phid'])
+        counts = defaultdict(int)
+        names = defaultdict(list)
+        for (actions, obj) in announces:
+            for author in actions:
+                if author in username_blacklist:
+                    continue
+                counts[author] += 1
+                if obj['name'] not in names[author]:
+                    names[author].append(obj['name'])
+
+        # Most active authors first
+        authors = sorted(counts, key=lambda author: counts[author],
+                         reverse=True)
+        for author in authors[:self.digest_max_authors]:
+            object_names = ', '.join(
+                names[author][:self.digest_max_objects])
+            if len(names[author]) > self.digest_max_objects:
+                object_names += '…'
+            irc.queueMsg(ircmsgs.privmsg(channel, format('%s: %n on %s',
+                author, (counts[author], 'update'), object_names)))
+        others = authors[self.digest_max_authors:]
+        if others:
+            irc.queueMsg(ircmsgs.privmsg(channel, format('and %n from %n',
+                (sum(counts[author] for author in others), 'update'),
+                (len(others), 'other user'))))
+
+    def _fetch_backlog(self, conduit, host, after_key):
+        """Returns the stories more recent than the given chronological
+        key, oldest first, but only up to announce.backlog of the most
+        recent ones."""
+        backlog = self.registryValue('announce.backlog')
+        stories = self._sorted_stories(
+                conduit.feed.query(view='data', limit=backlog))
+        if len(stories) == backlog and \
+                int(stories[0]['chronologicalKey']) > int(after_key):
+            self.log.info('Phabricator: skipping the stories of %s older '
+                          'than the %i most recent ones.', host, backlog)
+        return [story for story in stories
+                if int(story['chronologicalKey']) > int(after_key)]
+
+    def _feed_state_filename(self):
+        return conf.supybot.directories.data.dirize('Phabricator.feed.json')
+
+    def _load_feed_state(self):
+        """Loads the feed cursors of the instances, and the last stories
+        announced on each channel, as saved before the bot was stopped."""
+        try:
+            with open(self._feed_state_filename()) as fd:
+                state = json.load(fd)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            self.log.exception('Phabricator: could not load the feed '
+                               'state:')
+            return
+        self._saved_feed_cursors = state.get('cursors', {})
+        for (network, channels) in state.get('channels', {}).items():
+            for (channel, key) in channels.items():
+                self._last_feed_announces[network, channel] = key
+
+    def _save_feed_state(self):
+        """Saves the feed cursors, by host as tokens are not written to
+        the disk, and the last story announced on each channel."""
+        if self._feed_scheduler.stopped:
+            # The plugin was unloaded or reloaded, and its new instance
+            # owns the file.
+            return
+        cursors = dict(self._saved_feed_cursors)
+        for ((host, _), key) in self._feed_cursors.items():
+            cursors[host] = key
+        channels = defaultdict(dict)
+        for ((network, channel), key) in self._last_feed_announces.items():
+            channels[network][channel] = key
+        try:
+            with utils.file.AtomicFile(self._feed_state_filename(),
+                                       makeBackupIfSmaller=False) as fd:
+                json.dump({'cursors': cursors, 'channels': channels}, fd)
+        except OSError:
+            self.log.exception('Phabricator: could not save the feed '
+                               'state:')
+
+    def _fetch_stories_after(self, conduit, after_key):
+        """Returns all the stories more recent than the given chronological
+        key, oldest first; paging through the feed until caught up."""
+        stories = []
+        while True:
+            page = self._sorted_stories(conduit.feed.query(
+                view='data',
+                before=int(after_key),
+                limit=self.feed_page_size))
+            page = [story for story in page
+                    if int(story['chronologicalKey']) > int(after_key)]
+            stories.extend(page)
+            if len(page) < self.feed_page_size:
+                return stories
+            after_key = page[-1]['chronologicalKey']
+
+    @staticmethod
+    def _sorted_stories(stories):
+        # Conduit returns an empty list instead of an empty dict when
+        # there are no stories.
+        if not stories:
+            return []
+        return sorted(stories.values(),
+                key=lambda story: int(story['chronologicalKey']))
+
+    def _stories_transactions(self, recipient, stories):
+        """Returns the list of transactions of each of the stories.
+
+        Stories about the same object share a single request, and the
+        requests for different objects are made concurrently."""
+        phids_by_object = defaultdict(set)
+        for story in stories:
+            phids_by_object[story['data']['objectPHID']].update(
+                    story['data']['transactionPHIDs'])
+
+        def fetch(item):
+            (object_phid, phids) = item
+            return list(self.get_transactions_by_phid(recipient,
+                    sorted(phids), object_phid).values())
+        transactions_by_object = dict(zip(phids_by_object,
+                self._transactions_executor.map(fetch,
+                    phids_by_object.items())))
+
+        return [
+            [trans for trans in
+             transactions_by_object[story['data']['objectPHID']]
+             if trans['phid'] in story['data']['transactionPHIDs']]
+            for story in stories]
+
+    def _story_actions(self, transactions, authors):
+        """Returns a dict mapping the name of each author of the story's
+        transactions to the list of their transactions' types."""
         actions = defaultdict(lambda: [])
-        for trans in transactions['data']:
-            actions[self.get_user_by_phid(channel, trans['authorPHID'])] \
+        for trans in transactions:
+            actions[authors[trans['authorPHID']]['name']] \
                     .append(trans['type'])
+        return actions
 
+    def _announce_story(self, irc, channel, actions, obj):
+        """Send a story to a channel."""
+        username_blacklist = self.registryValue('announce.usernameBlacklist',
+                    channel)
         parts = []
         for (author, author_actions) in actions.items():
             if author in username_blacklist:
@@ -28,9 +28,26 @@
 
 ###
 
+import os
+import sys
+import threading
+import json
+import sqlite3
+import unittest.mock
+
+import requests
+
+from phabricator import APIError, Result
+
 import supybot.conf as conf
 from supybot.test import *
 
+from . import conduit as conduit_module
+from .conduit import Conduit
+from .plugin import CommitIndex, FeedScheduler, ObjectRecord, \
+        PersistentCache, PhidCache, RepositoryIndex, TransactionRecord, \
+        cache_entry
+
 ENTRY1 = {
 		'authorPHID': 'PHID-USER-jyszzzys2aaakr2q2ijx',
 		'chronologicalKey': '6607410428317095759',
@@ -120,6 +137,30 @@ QUERY_PHID = {
                                     'https://forge.softwareheritage.org/p/vlorentz/'},
 }
 
+SEARCH_TASK = {
+    611: {'fields': {'authorPHID': 'PHID-USER-fozivtfr457sc7smrhtv',
+                     'dateModified': 1538410933,
+                     'name': 'support for external definitions in the '
+                             'svn/subversion loader',
+                     'ownerPHID': 'PHID-USER-jyszzzys2aaakr2q2ijx',
+                     'priority': {'name': 'Normal'},
+                     'status': {'name': 'Open'}},
+          'id': 611,
+          'phid': 'PHID-TASK-lwuvnwjjnenqsyan73om',
+          'type': 'TASK'},
+}
+
+REPOSITORIES = [
+    {'fields': {'callsign': 'DCORE', 'name': 'swh-core',
+                'shortName': 'swh-core'},
+     'id': 1,
+     'phid': 'PHID-REPO-qkpf5phmeaypfwbnhjp5'},
+    {'fields': {'callsign': 'DMOD', 'name': 'swh-model',
+                'shortName': 'swh-model'},
+     'id': 2,
+     'phid': 'PHID-REPO-3m2ylw4ulwt6mjy5vllq'},
+]
+
 SEARCH_TRANSACTION = {
 	('PHID-TASK-lwuvnwjjnenqsyan73om', ('PHID-XACT-TASK-cgdt45mjjymbxpk',)):
 		{'cursor': {'after': None, 'before': None, 'limit': 100},
@@ -179,7 +220,67 @@ SEARCH_TRANSACTION = {
            'type': 'update'}]}
     }
 
+def query_feed(feed, view, before=None, limit=100):
+    """Mimics feed.query: returns the most recent stories, or the oldest
+    ones more recent than the 'before' cursor."""
+    assert view == 'data', view
+    items = sorted(feed.items(),
+                   key=lambda item: int(item[1]['chronologicalKey']))
+    if before is None:
+        items = items[-limit:]
+    else:
+        items = [(phid, story) for (phid, story) in items
+                 if int(story['chronologicalKey']) > before][:limit]
+    return dict(items)
+
+TRANSACTIONS = {trans['phid']: trans
+                for result in SEARCH_TRANSACTION.values()
+                for trans in result['data']}
+
+def search_transactions(objectIdentifier, constraints, after=None,
+                        limit=100):
+    """Mimics transaction.search, including the paging of its results."""
+    assert set(constraints) == {'phids'}, constraints
+    data = [trans for trans in TRANSACTIONS.values()
+            if trans['objectPHID'] == objectIdentifier
+            and trans['phid'] in constraints['phids']]
+    start = int(after or 0)
+    page = data[start:start+limit]
+    if start + limit < len(data):
+        after = str(start + limit)
+    else:
+        after = None
+    return {
+        'cursor': {'after': after, 'before': None, 'limit': limit},
+        'data': page,
+    }
+
+def mock_search(objects):
+    """Returns a mock of a *.search method, looking up objects by id."""
+    @classmethod
+    def search(cls, *, constraints):
+        return Result({
+            'cursor': {'after': None, 'before': None, 'limit': 100},
+            'data': [objects[id_] for id_ in constraints['ids']
+                     if id_ in objects],
+        })
+    return search
+
 class BaseMockConduit:
+    class harbormaster:
+        class build:
+            search = mock_search({})
+
+    class differential:
+        class revision:
+            search = mock_search({})
+
+    class paste:
+        search = mock_search({})
+
+    class maniphest:
+        search = mock_search(SEARCH_TASK)
+
     class phid:
         @classmethod
         def query(cls, *, phids):
@@ -187,28 +288,98 @@ class BaseMockConduit:
 
     class transaction:
         @classmethod
-        def search(cls, *, objectIdentifier, constraints):
-            assert set(constraints) == {'phids'}, constraints
-            return SEARCH_TRANSACTION[objectIdentifier,
-                tuple(sorted(constraints['phids']))]
+        def search(cls, **kwargs):
+            return search_transactions(**kwargs)
 
 class PhabricatorTestCase(ChannelPluginTestCase):
     plugins = ('Phabricator',)
     config = {
-            'supybot.plugins.Phabricator.announce.interval': 1,
+            'supybot.plugins.Phabricator.announce.interval': 60,
+            'supybot.plugins.Phabricator.announce.maxInterval': 60,
             }
 
+    def _wait_for_poll(self):
+        """Makes the feed scheduler run the polls which are due, and
+        returns the first message sent in response."""
+        self.irc.getCallback('Phabricator')._feed_scheduler.wakeup()
+        return self.getMsg(' ', timeout=0.5)
+
+    def _next_poll(self):
+        """Moves the clock past the announce interval and its jitter, and
+        returns the first message sent by the next poll."""
+        timeFastForward(67)
+        return self._wait_for_poll()
+
+    def testSchedulerQueuesOnce(self):
+        polls = []
+        announce = True
+        instance = ('https://forge.example.org/api/', 'token')
+
+        class StubPlugin:
+            feed_poll_jitter = 0
+            log = self.irc.getCallback('Phabricator').log
+
+            def _update_feed_hook(self):
+                pass
+
+            def registryValue(self, name, channel=None):
+                return {'announce': announce, 'announce.interval': 60,
+                        'announce.maxInterval': 60,
+                        'announce.push.fallbackInterval': 900}[name]
+
+            def instance(self, channel):
+                return instance
+
+            def _update_instance_feed(self, host, token, subscribers):
+                polls.append((host, token))
+                return 0
+
+        scheduler = FeedScheduler(StubPlugin())
+        scheduler._rescan()
+        self.assertEqual(len(scheduler._queue), 1)
+
+        # Not announced for a while, while it is still queued
+        announce = False
+        scheduler._rescan()
+        announce = True
+        scheduler._rescan()
+        self.assertEqual(len(scheduler._queue), 1)
+        scheduler._poll(*scheduler._pop())
+        self.assertEqual(polls, [instance])
+        self.assertEqual(len(scheduler._queue), 1)
+
+        # Not announced anymore when polled: dropped from the queue,
+        # until it is announced again.
+        announce = False
+        scheduler._rescan()
+        scheduler._poll(*scheduler._pop())
+        self.assertEqual(polls, [instance])
+        self.assertEqual(scheduler._queue, [])
+        announce = True
+        scheduler._rescan()
+        self.assertEqual(len(scheduler._queue), 1)
+
+    def testAdaptiveInterval(self):
+        scheduler = self.irc.getCallback('Phabricator')._feed_scheduler
+        subscribers = [(self.irc, self.channel)]
+        instance = ('https://forge.example.org/api/', 'token')
+        with conf.supybot.plugins.Phabricator.announce.maxInterval \
+                .context(600):
+            intervals = [
+                scheduler._next_interval(*instance, subscribers, nb_stories)
+                for nb_stories in (0, 0, 0, 0, 0, 0, 3, 0)]
+        self.assertEqual(intervals, [60, 120, 240, 480, 600, 600, 60, 120])
+
     def testAnnounce(self):
         nb_mock_calls = 0
 
         class MockConduit(BaseMockConduit):
             class feed:
                 @classmethod
-                def query(cls, *, view):
+                def query(cls, **kwargs):
                     nonlocal nb_mock_calls
                     nb_mock_calls += 1
-                    self.assertEqual(view, 'data')
-                    return current_feed
+                    return query_feed(current_feed, **kwargs)
 
         def mock_get_conduit(*args):
             return MockConduit
@@ -219,21 +390,19 @@ class PhabricatorTestCase(ChannelPluginTestCase):
             # Check there are no announce the first time.
             current_feed = FEED1
             self.assertNotError('config channel plugins.Phabricator.announce True')
-            m = self.getMsg(' ', timeout=0.1)
+            m = self._wait_for_poll()
             self.assertEqual(nb_mock_calls, 1, m)
             self.assertIs(m, None)
-            time.sleep(1.1)
-            m = self.getMsg(' ', timeout=0.1)
+            m = self._next_poll()
             self.assertEqual(nb_mock_calls, 2, m)
             self.assertIs(m, None)
 
             # A new story, that should be announced only after the time interval.
             current_feed = FEED2
-            m = self.getMsg(' ', timeout=0.1)
+            m = self._wait_for_poll()
             self.assertEqual(nb_mock_calls, 2, m)
             self.assertIs(m, None)
-            time.sleep(1.1)
-            m = self.getMsg(' ', timeout=0.1)
+            m = self._next_poll()
             self.assertEqual(nb_mock_calls, 3, m)
             self.assertIsNot(m, None)
             self.assertEqual(m.args[1],
@@ -243,11 +412,10 @@ class PhabricatorTestCase(ChannelPluginTestCase):
 
             # Another new story.
             current_feed = FEED3
-            m = self.getMsg(' ', timeout=0.1)
+            m = self._wait_for_poll()
             self.assertEqual(nb_mock_calls, 3, m)
             self.assertIs(m, None)
-            time.sleep(1.1)
-            m = self.getMsg(' ', timeout=0.1)
+            m = self._next_poll()
             self.assertEqual(nb_mock_calls, 4, m)
             self.assertIsNot(m, None)
             self.assertIn(m.args[1],
@@ -264,11 +432,10 @@ class PhabricatorTestCase(ChannelPluginTestCase):
         class MockConduit(BaseMockConduit):
             class feed:
                 @classmethod
-                def query(cls, *, view):
+                def query(cls, **kwargs):
                     nonlocal nb_mock_calls
                     nb_mock_calls += 1
-                    self.assertEqual(view, 'data')
-                    return current_feed
+                    return query_feed(current_feed, **kwargs)
 
         def mock_get_conduit(*args):
             return MockConduit
@@ -280,11 +447,10 @@ class PhabricatorTestCase(ChannelPluginTestCase):
             # Check there are no announce the first time.
             current_feed = FEED1
             self.assertNotError('config channel plugins.Phabricator.announce True')
-            m = self.getMsg(' ', timeout=0.1)
+            m = self._wait_for_poll()
             self.assertEqual(nb_mock_calls, 1, m)
             self.assertIs(m, None)
-            time.sleep(1.1)
-            m = self.getMsg(' ', timeout=0.1)
+            m = self._next_poll()
             self.assertEqual(nb_mock_calls, 2, m)
             self.assertIs(m, None)
 
@@ -292,17 +458,1202 @@ class PhabricatorTestCase(ChannelPluginTestCase):
             bl_conf = conf.supybot.plugins.Phabricator.announce.usernameBlacklist
             with bl_conf.context({'ardumont'}):
                 current_feed = FEED2
-                m = self.getMsg(' ', timeout=0.1)
+                m = self._wait_for_poll()
                 self.assertEqual(nb_mock_calls, 2, m)
                 self.assertIs(m, None)
-                time.sleep(1.1)
-                m = self.getMsg(' ', timeout=0.1)
+                m = self._next_poll()
                 self.assertEqual(nb_mock_calls, 3, m)
                 self.assertIs(m, None)
         finally:
             self.assertNotError('config channel plugins.Phabricator.announce False')
 
+    def testAnnouncePaging(self):
+        nb_mock_calls = 0
+        phid_queries = []
+
+        class MockConduit(BaseMockConduit):
+            class feed:
+                @classmethod
+                def query(cls, **kwargs):
+                    nonlocal nb_mock_calls
+                    nb_mock_calls += 1
+                    return query_feed(current_feed, **kwargs)
+
+            class phid:
+                @classmethod
+                def query(cls, *, phids):
+                    phid_queries.append(set(phids))
+                    return BaseMockConduit.phid.query(phids=phids)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+        cb.feed_page_size = 1
+
+        try:
+            current_feed = FEED1
+            self.assertNotError('config channel plugins.Phabricator.announce True')
+            m = self._wait_for_poll()
+            self.assertEqual(nb_mock_calls, 1, m)
+            self.assertIs(m, None)
+
+            # Two new stories with the same epoch, more than a page.
+            current_feed = dict(FEED3)
+            current_feed['phid-stry-zzphs53tpt6j7equbkp7'] = dict(
+                    ENTRY3, epoch=ENTRY2['epoch'])
+            m = self._next_poll()
+            self.assertIsNot(m, None)
+            self.assertTrue(m.args[1].startswith('comment from ardumont; '),
+                    m)
+            m = self.getMsg(' ', timeout=0.5)
+            self.assertIsNot(m, None)
+            self.assertTrue(m.args[1].startswith('comment+update from '
+                    'vlorentz; '), m)
+            self.assertEqual(nb_mock_calls, 4)
+            # The authors of both stories are resolved at once.
+            self.assertEqual(phid_queries, [
+                {ENTRY2['data']['objectPHID'], ENTRY3['data']['objectPHID']},
+                {ENTRY2['authorPHID'], ENTRY3['authorPHID']},
+            ])
+
+            # Nothing new
+            m = self._next_poll()
+            self.assertIs(m, None)
+            self.assertEqual(nb_mock_calls, 5)
+        finally:
+            self.assertNotError('config channel plugins.Phabricator.announce False')
+
+    def testAnnounceAfterRestart(self):
+        class MockConduit(BaseMockConduit):
+            class feed:
+                @classmethod
+                def query(cls, **kwargs):
+                    return query_feed(current_feed, **kwargs)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+
+        try:
+            current_feed = FEED1
+            self.assertNotError('config channel plugins.Phabricator.announce True')
+            m = self._wait_for_poll()
+            self.assertIs(m, None)
+
+            # Restarted while two stories are published: only the most
+            # recent one fits in the backlog.
+            cb._feed_cursors.clear()
+            cb._last_feed_announces.clear()
+            cb._load_feed_state()
+            current_feed = FEED3
+            with conf.supybot.plugins.Phabricator.announce.backlog.context(1):
+                m = self._next_poll()
+            self.assertTrue(m.args[1].startswith('comment+update from '
+                    'vlorentz; '), m)
+            self.assertIs(self.getMsg(' ', timeout=0.5), None)
+
+            with open(cb._feed_state_filename()) as fd:
+                state = json.load(fd)
+            self.assertEqual(state['channels'][self.irc.network],
+                             {self.channel: ENTRY3['chronologicalKey']})
+
+            # Restarted again, without new stories.
+            cb._feed_cursors.clear()
+            cb._last_feed_announces.clear()
+            cb._load_feed_state()
+            self.assertIs(self._next_poll(), None)
+        finally:
+            self.assertNotError('config channel plugins.Phabricator.announce False')
+
+    def testFeedStateAfterStop(self):
+        cb = self.irc.getCallback('Phabricator')
+        host = 'https://forge.example.org/api/'
+        cb._feed_cursors[host, 'token'] = '1'
+        cb._save_feed_state()
+
+        # The scheduler of an unloaded plugin may still be polling; it
+        # must not overwrite the state of the new instance.
+        cb._feed_scheduler.stop()
+        cb._feed_cursors[host, 'token'] = '2'
+        cb._save_feed_state()
+        with open(cb._feed_state_filename()) as fd:
+            state = json.load(fd)
+        self.assertEqual(state['cursors'][host], '1')
+
+    def testAnnounceDigest(self):
+        class MockConduit(BaseMockConduit):
+            class feed:
+                @classmethod
+                def query(cls, **kwargs):
+                    return query_feed(current_feed, **kwargs)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        self.irc.getCallback('Phabricator').conduit_for_host_token = \
+                mock_get_conduit
+
+        try:
+            current_feed = FEED1
+            self.assertNotError('config channel plugins.Phabricator.announce True')
+            m = self._wait_for_poll()
+            self.assertIs(m, None)
+
+            # Two new stories, over the threshold.
+            current_feed = FEED3
+            digest_conf = conf.supybot.plugins.Phabricator.announce \
+                    .digestThreshold
+            with digest_conf.context(1):
+                m = self._next_poll()
+            self.assertEqual(m.args[1], 'ardumont: 1 update on T611')
+            m = self.getMsg(' ', timeout=0.5)
+            self.assertEqual(m.args[1], 'vlorentz: 1 update on D453')
+            self.assertIs(self.getMsg(' ', timeout=0.5), None)
+        finally:
+            self.assertNotError('config channel plugins.Phabricator.announce False')
+
+    def testAnnounceSameObject(self):
+        transaction_searches = []
+
+        class MockConduit(BaseMockConduit):
+            class feed:
+                @classmethod
+                def query(cls, **kwargs):
+                    return query_feed(current_feed, **kwargs)
+
+            class transaction:
+                @classmethod
+                def search(cls, **kwargs):
+                    transaction_searches.append(kwargs)
+                    return search_transactions(limit=1, **kwargs)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        self.irc.getCallback('Phabricator').conduit_for_host_token = \
+                mock_get_conduit
+
+        try:
+            current_feed = FEED1
+            self.assertNotError('config channel plugins.Phabricator.announce True')
+            m = self._wait_for_poll()
+            self.assertIs(m, None)
+
+            # Two stories about the same revision.
+            (comment, update) = ENTRY3['data']['transactionPHIDs']
+            current_feed = dict(FEED1)
+            current_feed['phid-stry-1'] = dict(ENTRY3, data=dict(
+                ENTRY3['data'], transactionPHIDs={comment: comment}))
+            current_feed['phid-stry-2'] = dict(ENTRY3, data=dict(
+                ENTRY3['data'], transactionPHIDs={update: update}),
+                chronologicalKey=str(int(ENTRY3['chronologicalKey']) + 1))
+            m = self._next_poll()
+            self.assertTrue(m.args[1].startswith('comment from vlorentz; '),
+                    m)
+            m = self.getMsg(' ', timeout=0.5)
+            self.assertTrue(m.args[1].startswith('update from vlorentz; '),
+                    m)
+
+            # A single search for both stories, in two pages.
+            self.assertEqual(transaction_searches, [
+                {'objectIdentifier': ENTRY3['data']['objectPHID'],
+                 'constraints': {'phids': sorted([comment, update])}},
+                {'objectIdentifier': ENTRY3['data']['objectPHID'],
+                 'constraints': {'phids': sorted([comment, update])},
+                 'after': '1'},
+            ])
+        finally:
+            self.assertNotError('config channel plugins.Phabricator.announce False')
+
+    def testAnnounceSharedFeed(self):
+        nb_mock_calls = 0
+
+        class MockConduit(BaseMockConduit):
+            class feed:
+                @classmethod
+                def query(cls, **kwargs):
+                    nonlocal nb_mock_calls
+                    nb_mock_calls += 1
+                    return query_feed(current_feed, **kwargs)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        self.irc.getCallback('Phabricator').conduit_for_host_token = \
+                mock_get_conduit
+
+        self.irc.feedMsg(ircmsgs.join('#other', prefix=self.prefix))
+        while self.irc.takeMsg():
+            pass
+
+        try:
+            current_feed = FEED1
+            self.assertNotError('config channel plugins.Phabricator.announce True')
+            self.assertNotError('config channel #other '
+                                'plugins.Phabricator.announce True')
+            m = self._wait_for_poll()
+            self.assertEqual(nb_mock_calls, 1, m)
+            self.assertIs(m, None)
+
+            # One query for both channels, announced on each of them.
+            current_feed = FEED2
+            m1 = self._next_poll()
+            m2 = self.getMsg(' ', timeout=0.5)
+            self.assertEqual(nb_mock_calls, 2)
+            self.assertEqual({m1.args[0], m2.args[0]}, {self.channel, '#other'})
+            self.assertEqual(m1.args[1], m2.args[1])
+        finally:
+            self.assertNotError('config channel plugins.Phabricator.announce False')
+            self.assertNotError('config channel #other '
+                                'plugins.Phabricator.announce False')
+
+    def testTaskReply(self):
+        phid_queries = []
+
+        class MockConduit(BaseMockConduit):
+            class phid:
+                @classmethod
+                def query(cls, *, phids):
+                    phid_queries.append(phids)
+                    return BaseMockConduit.phid.query(phids=phids)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        self.irc.getCallback('Phabricator').conduit_for_host_token = \
+                mock_get_conduit
+
+        m = self.getMsg('see T611#42 for details', usePrefixChar=False)
+        self.assertEqual(m.args[1],
+                '\x02T611\x02 (submitter: ardumont, owner: vlorentz, '
+                'status: Open): support for external definitions in the '
+                'svn/subversion loader '
+                '<https://forge.softwareheritage.org/T611#42>')
+        # The task and both users are fetched at once.
+        self.assertEqual(len(phid_queries), 1)
+
+    def testMultipleReferences(self):
+        phid_queries = []
+        searches = []
+
+        class MockConduit(BaseMockConduit):
+            class phid:
+                @classmethod
+                def query(cls, *, phids):
+                    phid_queries.append(phids)
+                    return BaseMockConduit.phid.query(phids=phids)
+
+            class maniphest:
+                @classmethod
+                def search(cls, *, constraints):
+                    searches.append(constraints['ids'])
+                    return BaseMockConduit.maniphest.search(
+                            constraints=constraints)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        self.irc.getCallback('Phabricator').conduit_for_host_token = \
+                mock_get_conduit
+
+        m = self.getMsg('see T611, T12 and T611#42', usePrefixChar=False)
+        self.assertTrue(m.args[1].endswith(
+                '<https://forge.softwareheritage.org/T611>'), m)
+        m = self.getMsg(' ', timeout=0.5)
+        self.assertTrue(m.args[1].endswith(
+                '<https://forge.softwareheritage.org/T611#42>'), m)
+        self.assertEqual(searches, [[611, 12]])
+        self.assertEqual(len(phid_queries), 1)
+
+    def testReplyCache(self):
+        phid_queries = []
+        task = SEARCH_TASK[611]
+
+        class MockConduit(BaseMockConduit):
+            class phid:
+                @classmethod
+                def query(cls, *, phids):
+                    phid_queries.append(phids)
+                    return BaseMockConduit.phid.query(phids=phids)
+
+            class maniphest:
+                search = mock_search({611: task})
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        self.irc.getCallback('Phabricator').conduit_for_host_token = \
+                mock_get_conduit
+
+        m = self.getMsg('see T611', usePrefixChar=False)
+        reply = m.args[1]
+        self.assertEqual(len(phid_queries), 1)
+
+        # Not modified since: the reply is not rendered again.
+        m = self.getMsg('see T611', usePrefixChar=False)
+        self.assertEqual(m.args[1], reply)
+        self.assertEqual(len(phid_queries), 1)
+
+        # Modified: rendered again.
+        task = dict(task, fields=dict(task['fields'], name='renamed',
+                                      dateModified=1538410934))
+        MockConduit.maniphest.search = mock_search({611: task})
+        m = self.getMsg('see T611', usePrefixChar=False)
+        self.assertIn('renamed', m.args[1])
+        reply = m.args[1]
+
+        # Identical replies are not repeated during the cooldown.
+        with conf.supybot.plugins.Phabricator.replyCooldown.context(60):
+            m = self.getMsg('see T611', usePrefixChar=False)
+            self.assertEqual(m.args[1], reply)
+            m = self.getMsg('see T611', usePrefixChar=False, timeout=0.5)
+            self.assertIs(m, None)
+            timeFastForward(61)
+            m = self.getMsg('see T611', usePrefixChar=False)
+            self.assertEqual(m.args[1], reply)
+
+    def testBuilds(self):
+        buildable_queries = []
+        phid_queries = []
+        builds = {
+            id_: {'id': id_, 'phid': 'PHID-HBLD-%d' % id_,
+                  'fields': {'buildablePHID': buildable_phid,
+                             'name': 'build %d' % id_,
+                             'buildStatus': {'name': 'passed'}}}
+            for (id_, buildable_phid) in ((1, 'PHID-HMBB-1'),
+                                          (2, 'PHID-HMBB-1'),
+                                          (3, 'PHID-HMBB-gone'))}
+        build_phids = {
+            build['phid']: {'fullName': 'B%d' % id_, 'name': 'B%d' % id_,
+                            'phid': build['phid'], 'status': 'open',
+                            'type': 'HBLD', 'typeName': 'Build',
+                            'uri': 'https://forge.softwareheritage.org/'
+                                   'harbormaster/build/%d/' % id_}
+            for (id_, build) in builds.items()}
+
+        class MockConduit(BaseMockConduit):
+            class harbormaster:
+                class build:
+                    search = mock_search(builds)
+
+                @classmethod
+                def querybuildables(cls, *, phids):
+                    buildable_queries.append(sorted(phids))
+                    return Result({'data': [
+                        {'phid': 'PHID-HMBB-1',
+                         'buildablePHID': 'PHID-DREV-jaamseb4cyq2glp3ekmr',
+                         'containerPHID': None}]})
+
+            class phid:
+                @classmethod
+                def query(cls, *, phids):
+                    phid_queries.append(phids)
+                    return {phid: dict(QUERY_PHID, **build_phids)[phid]
+                            for phid in phids}
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        self.irc.getCallback('Phabricator').conduit_for_host_token = \
+                mock_get_conduit
+
+        # The build whose buildable is gone is skipped.
+        m = self.getMsg('see B1, B2 and B3', usePrefixChar=False)
+        self.assertIn('B1\x02 for D454: Provide Sphinx targets', m.args[1])
+        self.assertIn('build 1', m.args[1])
+        m = self.getMsg(' ', timeout=1)
+        self.assertIn('build 2', m.args[1])
+        self.assertNoResponse(' ', timeout=0.5)
+        self.assertEqual(buildable_queries,
+                         [['PHID-HMBB-1', 'PHID-HMBB-gone']])
+        self.assertEqual(len(phid_queries), 1)
+
+    def testBrokenObject(self):
+        broken_task = dict(SEARCH_TASK[611], id=1)
+        broken_task['fields'] = dict(broken_task['fields'])
+        del broken_task['fields']['priority']
+
+        class MockConduit(BaseMockConduit):
+            class maniphest:
+                search = mock_search({1: broken_task, 611: SEARCH_TASK[611]})
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        self.irc.getCallback('Phabricator').conduit_for_host_token = \
+                mock_get_conduit
+
+        # The other references are still replied to.
+        with self.assertLogs('supybot', level='ERROR'):
+            m = self.getMsg('see T1 and T611', usePrefixChar=False)
+        self.assertIn('T611', m.args[1])
+        self.assertNoResponse(' ', timeout=0.5)
+
+    def testPendingReplies(self):
+        unblock = threading.Event()
+
+        class MockConduit(BaseMockConduit):
+            class maniphest:
+                @classmethod
+                def search(cls, *, constraints):
+                    unblock.wait(5)
+                    return BaseMockConduit.maniphest.search(
+                        constraints=constraints)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+        cb._pending_replies = threading.BoundedSemaphore(1)
+
+        # The second message is dropped while the first one waits for
+        # the instance.
+        self.assertNoResponse('see T611', timeout=0.2, usePrefixChar=False)
+        with self.assertLogs('supybot', level='WARNING'):
+            self.assertNoResponse('see T611 again', timeout=0.2,
+                                  usePrefixChar=False)
+        unblock.set()
+        m = self.getMsg(' ', timeout=1)
+        self.assertIn('T611', m.args[1])
+        self.assertNoResponse(' ', timeout=0.5)
+
+    def testUnknownCommit(self):
+        nb_mock_calls = 0
+
+        class MockConduit(BaseMockConduit):
+            class diffusion:
+                @classmethod
+                def querycommits(cls, *, names):
+                    nonlocal nb_mock_calls
+                    nb_mock_calls += 1
+                    return Result({'data': {}, 'identifierMap': {}})
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        self.irc.getCallback('Phabricator').conduit_for_host_token = \
+                mock_get_conduit
+
+        self.assertNoResponse('sha1 is 0123456789abcdef', timeout=0.2,
+                              usePrefixChar=False)
+        self.assertNoResponse('sha1 is 0123456789abcdef', timeout=0.2,
+                              usePrefixChar=False)
+        self.assertEqual(nb_mock_calls, 1)
+
+        # It may have been imported since.
+        timeFastForward(61)
+        self.assertNoResponse('sha1 is 0123456789abcdef', timeout=0.2,
+                              usePrefixChar=False)
+        self.assertEqual(nb_mock_calls, 2)
+
+    def testCommitIndex(self):
+        commits = [{'id': id_, 'fields': {'identifier': identifier}}
+                   for (id_, identifier) in ((3, 'cccccccccc'),
+                                             (2, 'bbbbbbbbbb'),
+                                             (1, 'aaaaaaaaaa'))]
+        searches = []
+
+        class MockConduit:
+            class diffusion:
+                class commit:
+                    @classmethod
+                    def search(cls, *, order, limit, after=None):
+                        searches.append(after)
+                        start = int(after or 0)
+                        page = commits[start:start+limit]
+                        if start + limit < len(commits):
+                            after = str(start + limit)
+                        else:
+                            after = None
+                        return {'data': page, 'cursor': {'after': after}}
+
+        index = CommitIndex()
+        index.page_size = 2
+        self.assertTrue(index.may_contain('0123456789'))
+        index.sync(MockConduit)
+        self.assertEqual(searches, [None, '2'])
+        self.assertTrue(index.may_contain('bbbbbbbbbbbb'))
+        self.assertFalse(index.may_contain('0123456789'))
+
+        # Only the new commits are fetched
+        commits.insert(0, {'id': 4, 'fields': {'identifier': '0123456789'}})
+        searches.clear()
+        index.sync(MockConduit)
+        self.assertEqual(searches, [None])
+        self.assertTrue(index.may_contain('0123456789'))
+
+        # Refreshed on misses, at most every min_refresh_interval seconds
+        commits.insert(0, {'id': 5, 'fields': {'identifier': 'dddddddddd'}})
+        searches.clear()
+        self.assertTrue(index.refresh(MockConduit))
+        self.assertEqual(searches, [])
+        self.assertFalse(index.may_contain('dddddddddd'))
+        timeFastForward(index.min_refresh_interval)
+        self.assertTrue(index.refresh(MockConduit))
+        self.assertEqual(searches, [None])
+        self.assertTrue(index.may_contain('dddddddddd'))
+
+    def testRepositoryIndex(self):
+        searches = []
+
+        class MockConduit(BaseMockConduit):
+            class diffusion:
+                class repository:
+                    @classmethod
+                    def search(cls, *, constraints=None, order=None,
+                               limit=100, after=None):
+                        searches.append((constraints, after))
+                        if constraints:
+                            repos = [repo for repo in REPOSITORIES
+                                     if repo['fields']['callsign']
+                                     in constraints['callsigns']]
+                            return Result({'data': repos,
+                                           'cursor': {'after': None}})
+                        newest = sorted(repositories,
+                                        key=lambda repo: -repo['id'])
+                        start = int(after or 0)
+                        after = str(start + limit)
+                        if start + limit >= len(newest):
+                            after = None
+                        return Result({
+                            'data': newest[start:start+limit],
+                            'cursor': {'after': after}})
+
+        repositories = list(REPOSITORIES)
+        index = RepositoryIndex()
+        index.page_size = 1
+        index.sync(MockConduit)
+        self.assertEqual(searches, [(None, None), (None, '1')])
+        self.assertEqual(index.get_by_callsign('DMOD'), REPOSITORIES[1])
+        self.assertEqual(index.get_by_short_name('swh-core'),
+                         REPOSITORIES[0])
+
+        # Only the new repositories are fetched
+        renamed = dict(REPOSITORIES[0], fields=dict(
+            REPOSITORIES[0]['fields'], callsign='DRENAMED'))
+        new = {'fields': {'callsign': 'DNEW', 'name': 'swh-new',
+                          'shortName': 'swh-new'},
+               'id': 3, 'phid': 'PHID-REPO-new'}
+        repositories[:] = [renamed, REPOSITORIES[1], new]
+        searches.clear()
+        index.sync(MockConduit)
+        self.assertEqual(searches, [(None, None), (None, '1')])
+        self.assertEqual(index.get_by_callsign('DNEW'), new)
+        self.assertEqual(index.get_by_callsign('DCORE'), REPOSITORIES[0])
+
+        # Then all of them, forgetting the old names
+        timeFastForward(index.full_sync_interval)
+        index.sync(MockConduit)
+        self.assertEqual(index.get_by_callsign('DCORE'), None)
+        self.assertEqual(index.get_by_callsign('DRENAMED'), renamed)
+        self.assertEqual(index.get_by_short_name('swh-core'), renamed)
+        self.assertEqual(index.get_by_callsign('DNEW'), new)
+
+        # Renamed repositories added to the index lose their old names
+        index.add(REPOSITORIES[0])
+        self.assertEqual(index.get_by_callsign('DRENAMED'), None)
+        self.assertEqual(index.get_by_callsign('DCORE'), REPOSITORIES[0])
+
+        # Lookups are served by the index, and repositories missing from
+        # it are fetched and added to it.
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+        index = RepositoryIndex()
+        index.add(REPOSITORIES[0])
+        cb._repository_indexes[cb.instance(self.channel)] = index
+        searches.clear()
+        self.assertEqual(cb.get_repo(self.channel, REPOSITORIES[0]['phid']),
+                         REPOSITORIES[0])
+        self.assertEqual(searches, [])
+        self.assertEqual(cb.get_repo_by_callsign(self.channel, 'DMOD'),
+                         REPOSITORIES[1])
+        self.assertEqual(cb.get_repo_by_callsign(self.channel, 'DMOD'),
+                         REPOSITORIES[1])
+        self.assertEqual(searches, [({'callsigns': ['DMOD']}, None)])
+
+    def testWarmUp(self):
+        users = [
+            {'id': 1, 'type': 'USER', 'phid': phid,
+             'fields': {'username': QUERY_PHID[phid]['name'],
+                        'realName': real_name,
+                        'roles': ['verified', 'approved', 'activated']}}
+            for (phid, real_name) in [
+                ('PHID-USER-jyszzzys2aaakr2q2ijx', 'vlorentz'),
+                ('PHID-USER-fozivtfr457sc7smrhtv', 'Antoine R. Dumont')]]
+
+        class MockConduit(BaseMockConduit):
+            class phid:
+                @classmethod
+                def query(cls, *, phids):
+                    raise AssertionError('Unexpected phid.query')
+
+            class user:
+                @classmethod
+                def search(cls, *, limit, after=None):
+                    start = int(after or 0)
+                    after = str(start + limit)
+                    if start + limit >= len(users):
+                        after = None
+                    return Result({'data': users[start:start+limit],
+                                   'cursor': {'after': after}})
+
+            class diffusion:
+                class repository:
+                    @classmethod
+                    def search(cls, *, order, limit, after=None):
+                        return Result({'data': REPOSITORIES[::-1],
+                                       'cursor': {'after': None}})
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+        cb.warm_up_page_size = 1
+
+        plugin_conf = conf.supybot.plugins.Phabricator
+        with plugin_conf.phabricatorURI.context(
+                    'https://forge.softwareheritage.org/api/'), \
+                plugin_conf.phabricatorConduitToken.context('token'):
+            cb._warm_up_instances([cb.instance(self.channel)])
+
+            # Found in the cache, as phid.query would have returned them.
+            for phid in ('PHID-USER-jyszzzys2aaakr2q2ijx',
+                         'PHID-USER-fozivtfr457sc7smrhtv'):
+                self.assertEqual(
+                    cb.get_object_by_phid(self.channel, phid),
+                    ObjectRecord.from_conduit(QUERY_PHID[phid]))
+            self.assertEqual(
+                cb.get_repo_by_callsign(self.channel, 'DMOD'),
+                REPOSITORIES[1])
+
+    def testConduitClient(self):
+        calls = []
+        responses = [
+            {'result': {'PHID-USER-1': {'name': 'foo'}},
+             'error_code': None, 'error_info': None},
+            {'result': None,
+             'error_code': 'ERR-CONDUIT-CORE', 'error_info': 'Oops'},
+        ]
+
+        class MockResponse:
+            def __init__(self, data):
+                self._data = data
+
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return self._data
+
+        class MockSession:
+            def post(self, url, data, timeout):
+                calls.append((url, json.loads(data['params']), timeout))
+                return MockResponse(responses.pop(0))
+
+        client = Conduit('https://forge.example.org/api/', 'api-token',
+                         connect_timeout=2, read_timeout=10)
+        client.session = MockSession()
+
+        r = client.phid.query(phids=['PHID-USER-1'])
+        self.assertEqual(r.response, {'PHID-USER-1': {'name': 'foo'}})
+        self.assertEqual(calls, [(
+            'https://forge.example.org/api/phid.query',
+            {'phids': ['PHID-USER-1'],
+             '__conduit__': {'token': 'api-token'}},
+            (2, 10))])
+
+        with self.assertRaises(APIError):
+            client.diffusion.repository.search(constraints={})
+        self.assertEqual(calls[-1][0],
+                'https://forge.example.org/api/diffusion.repository.search')
+
+        # Required arguments are checked before calling Conduit
+        with self.assertRaises(ValueError):
+            client.phid.query()
+        self.assertEqual(len(calls), 2)
+
+    def testConduitCircuitBreaker(self):
+        calls = []
+        delay = 0
+
+        class MockResponse:
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return {'result': {}, 'error_code': None, 'error_info': None}
+
+        class MockSession:
+            def post(self, url, data, timeout):
+                calls.append(url)
+                if delay:
+                    time.sleep(delay)
+                if failing:
+                    raise requests.ConnectionError('Connection refused')
+                return MockResponse()
+
+            def close(self):
+                pass
+
+        host = 'https://forge.example.org/api/'
+        client = Conduit(host, 'api-token', call_timeout=0.2,
+                         failure_threshold=2, cooldown=60)
+        client.session = MockSession()
+        cb = self.irc.getCallback('Phabricator')
+        cb._conduits[host, 'api-token'] = client
+
+        failing = True
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                client.phid.query(phids=['PHID-USER-1'])
+        self.assertRegexp('conduitstatus',
+                          '%s: open for .*, after 2 failures' % host)
+
+        # Rejected without calling the host. (The exception class is
+        # looked up from the module, which may have been reloaded since
+        # this file imported it.)
+        with self.assertRaises(conduit_module.ConduitUnavailable):
+            client.phid.query(phids=['PHID-USER-1'])
+        self.assertEqual(len(calls), 2)
+
+        # After the cooldown, a call is tried again.
+        timeFastForward(61)
+        self.assertResponse('conduitstatus',
+                            '%s: half-open (2 failures)' % host)
+        failing = False
+        client.phid.query(phids=['PHID-USER-1'])
+        self.assertEqual(len(calls), 3)
+        self.assertResponse('conduitstatus', '%s: closed (0 failures)' % host)
+
+        # Calls which take too long count as failures.
+        delay = 0.5
+        with self.assertRaises(conduit_module.ConduitUnavailable):
+            client.phid.query(phids=['PHID-USER-2'])
+        self.assertEqual(client.breaker.failures, 1)
+
+        # A call let through after the cooldown which fails before
+        # reaching the host does not keep the circuit open.
+        client.breaker.opened_at = time.time() - 61
+        with unittest.mock.patch.object(
+                client._executor, 'submit', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                client.phid.query(phids=['PHID-USER-3'])
+        delay = 0
+        client.phid.query(phids=['PHID-USER-3'])
+        self.assertResponse('conduitstatus', '%s: closed (0 failures)' % host)
+
+    def testConduitSingleFlight(self):
+        calls = []
+        release = threading.Event()
+
+        class MockResponse:
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return {'result': {'PHID-USER-1': {'name': 'foo'}},
+                        'error_code': None, 'error_info': None}
+
+        class MockSession:
+            def post(self, url, data, timeout):
+                calls.append(url)
+                release.wait(5)
+                return MockResponse()
+
+        client = Conduit('https://forge.example.org/api/', 'api-token')
+        client.session = MockSession()
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                client.phid.query(phids=['PHID-USER-1'])))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        # The concurrent identical calls were sent once.
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        for r in results:
+            self.assertEqual(r.response, {'PHID-USER-1': {'name': 'foo'}})
+
+        # Later calls are sent again.
+        client.phid.query(phids=['PHID-USER-1'])
+        self.assertEqual(len(calls), 2)
+
+    def testInterfacesCache(self):
+        calls = []
+        interfaces = {
+            'phid.query': {'params': {'phids': 'required list<phid>'}},
+            'foo.bar': {'params': {'baz': 'required string'}},
+        }
+
+        def mock_call(client, method, **kwargs):
+            calls.append(method)
+            return Result(interfaces)
+
+        cb = self.irc.getCallback('Phabricator')
+        host = 'https://forge.example.org/api/'
+        filename = cb._interfaces_filename(host)
+        # The plugin may have been reloaded since this module was imported.
+        conduit_class = sys.modules[type(cb).__module__].Conduit
+        with unittest.mock.patch.object(conduit_class, 'call', mock_call):
+            # Not cached yet: the description is fetched in the background.
+            conduit = cb.conduit_for_host_token(host, 'token1')
+            for _ in range(20):
+                if os.path.exists(filename):
+                    break
+                time.sleep(0.1)
+            self.assertEqual(calls, ['conduit.query'])
+            self.assertIn('foo', conduit.interfaces)
+
+            # Cached: loaded from the disk without calling Conduit.
+            conduit = cb.conduit_for_host_token(host, 'token2')
+            self.assertIn('foo', conduit.interfaces)
+            time.sleep(0.2)
+            self.assertEqual(calls, ['conduit.query'])
+
+            # Refreshed when expired.
+            def wait_for_call(nb_calls):
+                for _ in range(20):
+                    if len(calls) >= nb_calls:
+                        break
+                    time.sleep(0.1)
+            timeFastForward(cb.interfaces_cache_expiry + 1)
+            cb._check_all_interfaces()
+            wait_for_call(3)
+            self.assertEqual(calls, ['conduit.query'] * 3)
+            time.sleep(0.2)  # Let them write the file
+
+            # A malformed file is fetched again.
+            calls.clear()
+            with open(filename, 'w') as fd:
+                json.dump({'interfaces': interfaces}, fd)
+            conduit = cb.conduit_for_host_token(host, 'token3')
+            wait_for_call(1)
+            self.assertEqual(calls, ['conduit.query'])
+
+    def testCacheSharedByInstance(self):
+        nb_mock_calls = 0
+
+        class MockConduit(BaseMockConduit):
+            class phid:
+                @classmethod
+                def query(cls, *, phids):
+                    nonlocal nb_mock_calls
+                    nb_mock_calls += 1
+                    return BaseMockConduit.phid.query(phids=phids)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+
+        phid = 'PHID-USER-jyszzzys2aaakr2q2ijx'
+        self.assertEqual(cb.get_user_by_phid(self.channel, phid), 'vlorentz')
+        self.assertEqual(cb.get_user_by_phid('#other', phid), 'vlorentz')
+        self.assertEqual(cb.get_user_by_phid('someone', phid), 'vlorentz')
+        self.assertEqual(nb_mock_calls, 1)
+
+    def testRevalidateObjects(self):
+        phid_queries = []
+
+        class MockConduit(BaseMockConduit):
+            class phid:
+                @classmethod
+                def query(cls, *, phids):
+                    phid_queries.append(phids)
+                    return BaseMockConduit.phid.query(phids=phids)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+
+        phid = 'PHID-TASK-lwuvnwjjnenqsyan73om'
+        objects = cb.get_objects_by_phid(self.channel, [phid],
+                                         revalidate=True)
+        self.assertEqual(objects[phid]['name'], 'T611')
+        self.assertEqual(phid_queries, [[phid]])
+
+        # Fresh: served from the cache.
+        cb.get_objects_by_phid(self.channel, [phid], revalidate=True)
+        self.assertEqual(phid_queries, [[phid]])
+
+        # Stale: still served from the cache, but refreshed in the
+        # background.
+        timeFastForward(cb.phid_cache_revalidate_after + 1)
+        objects = cb.get_objects_by_phid(self.channel, [phid],
+                                         revalidate=True)
+        self.assertEqual(objects[phid]['name'], 'T611')
+        for _ in range(20):
+            if len(phid_queries) == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(phid_queries, [[phid], [phid]])
+        cb.get_objects_by_phid(self.channel, [phid], revalidate=True)
+        time.sleep(0.2)
+        self.assertEqual(len(phid_queries), 2)
+
+    def testTransactionCache(self):
+        nb_mock_calls = 0
+
+        class MockConduit(BaseMockConduit):
+            class transaction:
+                @classmethod
+                def search(cls, **kwargs):
+                    nonlocal nb_mock_calls
+                    nb_mock_calls += 1
+                    return search_transactions(**kwargs)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+
+        object_phid = ENTRY3['data']['objectPHID']
+        phids = sorted(ENTRY3['data']['transactionPHIDs'])
+        transactions = cb.get_transactions_by_phid(self.channel, phids,
+                                                   object_phid)
+        self.assertEqual(list(transactions), [
+            'PHID-XACT-DREV-5wapkzlcy3bhup4', 'PHID-XACT-DREV-b7dsk7hobiqoxn6'])
+        self.assertEqual(nb_mock_calls, 1)
+
+        # Served from the cache, in the same shape and order.
+        for recipient in (self.channel, '#other'):
+            self.assertEqual(
+                cb.get_transactions_by_phid(recipient, phids, object_phid),
+                transactions)
+            self.assertEqual(
+                cb.get_transactions_by_phid(recipient, phids[1:],
+                                            object_phid),
+                {phids[1]: transactions[phids[1]]})
+        self.assertEqual(nb_mock_calls, 1)
+
+    def testPhidCache(self):
+        cache = PhidCache(2)
+        cache.set('a', cache_entry('A', time.time() + 60))
+        cache.set('b', cache_entry('B', time.time() + 60))
+        self.assertEqual(cache.get('a').data, 'A')
+        cache.set('c', cache_entry('C', time.time() + 60))
+
+        # 'b' was the least recently used entry
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c').data, 'C')
+        self.assertEqual((cache.hits, cache.misses, cache.evictions),
+                         (2, 1, 1))
+
+        # Misses are not inserted, and expired entries are dropped.
+        self.assertIsNone(cache.get('d'))
+        cache.set('a', cache_entry('A', time.time() - 1))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 1)
+
+        self.assertResponse('cachestats',
+                'objects: 0 entries, 0 hits, 0 misses, 0 evictions; '
+                'transactions: 0 entries, 0 hits, 0 misses, 0 evictions; '
+                'unknown commits: 0 entries, 0 hits, 0 misses, 0 evictions; '
+                'replies: 0 entries, 0 hits, 0 misses, 0 evictions')
+
+    def testRecords(self):
+        obj = QUERY_PHID['PHID-USER-jyszzzys2aaakr2q2ijx']
+        record = ObjectRecord.from_conduit(obj)
+        self.assertEqual(record['name'], 'vlorentz')
+        self.assertEqual(record.uri, obj['uri'])
+        self.assertIs(record.type, sys.intern('USER'))
+        with self.assertRaises(KeyError):
+            record['typeName']
+
+        # Serialized by the persistent cache
+        self.assertEqual(
+            ObjectRecord.from_json(json.loads(json.dumps(record))), record)
+        self.assertEqual(ObjectRecord.from_json(obj), record)
+
+        trans = TRANSACTIONS['PHID-XACT-TASK-cgdt45mjjymbxpk']
+        record = TransactionRecord.from_conduit(trans)
+        self.assertEqual(record['authorPHID'], trans['authorPHID'])
+        self.assertEqual(record['type'], 'comment')
+
+    def testPersistentCache(self):
+        filename = conf.supybot.directories.data.dirize(
+                'PhabricatorTest.sqlite')
+        expiry = time.time() + 60
+        cache = PersistentCache(filename)
+        cache.set('object', ('#test', 'PHID-TASK-1'),
+                  cache_entry({'name': 'T1'}, expiry))
+        cache.set('object', ('#test', 'PHID-TASK-2'),
+                  cache_entry({'name': 'T2'}, time.time() - 1))
+        cache.close()
+
+        # Reopened from disk; expired and missing entries are ignored.
+        cache = PersistentCache(filename)
+        self.assertEqual(
+            cache.get_many('object', [('#test', 'PHID-TASK-1'),
+                                      ('#test', 'PHID-TASK-2'),
+                                      ('#test', 'PHID-TASK-3')]),
+            {('#test', 'PHID-TASK-1'): cache_entry({'name': 'T1'}, expiry)})
+        cache.close()
+
+    def testPersistentCacheWithoutToken(self):
+        nb_mock_calls = 0
+
+        class MockConduit(BaseMockConduit):
+            class phid:
+                @classmethod
+                def query(cls, *, phids):
+                    nonlocal nb_mock_calls
+                    nb_mock_calls += 1
+                    return BaseMockConduit.phid.query(phids=phids)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+        filename = conf.supybot.directories.data.dirize(
+                'PhabricatorTest.sqlite')
+        cb._persistent_cache = PersistentCache(filename)
+
+        plugin_conf = conf.supybot.plugins.Phabricator
+        phid = 'PHID-USER-jyszzzys2aaakr2q2ijx'
+        with plugin_conf.phabricatorURI.context(
+                    'https://forge.softwareheritage.org/api/'), \
+                plugin_conf.phabricatorConduitToken.context('secret-token'):
+            self.assertEqual(cb.get_user_by_phid(self.channel, phid),
+                             'vlorentz')
+        cb._persistent_cache.close()
+
+        db = sqlite3.connect(filename)
+        keys = [key for (key,) in db.execute('SELECT key FROM cache')]
+        db.close()
+        self.assertEqual(len(keys), 1)
+        self.assertNotIn('secret-token', keys[0])
+
+        # Still found after the token is changed.
+        cb._phid_object_cache = PhidCache(10)
+        with plugin_conf.phabricatorURI.context(
+                    'https://forge.softwareheritage.org/api/'), \
+                plugin_conf.phabricatorConduitToken.context('new-token'):
+            self.assertEqual(cb.get_user_by_phid(self.channel, phid),
+                             'vlorentz')
+        self.assertEqual(nb_mock_calls, 1)
+        cb._persistent_cache.close()
+        cb._persistent_cache = None
+
+
+class PhabricatorPushTestCase(ChannelHTTPPluginTestCase):
+    plugins = ('Phabricator',)
+    config = {
+            'supybot.plugins.Phabricator.announce.interval': 60,
+            'supybot.plugins.Phabricator.announce.maxInterval': 60,
+            'supybot.plugins.Phabricator.announce.push': True,
+            'supybot.plugins.Phabricator.phabricatorURI':
+                'https://forge.softwareheritage.org/api/',
+            }
+
+    def testAnnouncePush(self):
+        nb_mock_calls = 0
+
+        class MockConduit(BaseMockConduit):
+            class feed:
+                @classmethod
+                def query(cls, **kwargs):
+                    nonlocal nb_mock_calls
+                    nb_mock_calls += 1
+                    return query_feed(current_feed, **kwargs)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+
+        try:
+            current_feed = FEED1
+            self.assertNotError('config channel plugins.Phabricator.announce True')
+            cb._feed_scheduler.wakeup()
+            self.assertIs(self.getMsg(' ', timeout=0.5), None)
+            self.assertEqual(nb_mock_calls, 1)
+
+            # Pushed: announced without waiting for the interval.
+            current_feed = FEED2
+            timeFastForward(cb.feed_push_min_interval)
+            self.assertHTTPResponse('/phabricator/forge.softwareheritage.org',
+                                    200, method='POST')
+            m = self.getMsg(' ', timeout=0.5)
+            self.assertEqual(nb_mock_calls, 2)
+            self.assertTrue(m.args[1].startswith('comment from ardumont; '),
+                    m)
+
+            # The feed is now only polled as a fallback.
+            timeFastForward(61)
+            cb._feed_scheduler.wakeup()
+            self.assertIs(self.getMsg(' ', timeout=0.5), None)
+            self.assertEqual(nb_mock_calls, 2)
+
+            self.assertHTTPResponse('/phabricator/', 400, method='POST')
+            self.assertHTTPResponse('/phabricator/forge.example.org', 404,
+                                    method='POST')
+
+            # Without hooks for the fallback interval, polled adaptively
+            # again.
+            fallback_conf = conf.supybot.plugins.Phabricator.announce.push \
+                    .fallbackInterval
+            with fallback_conf.context(100):
+                timeFastForward(1000)
+                cb._feed_scheduler.wakeup()
+                self.assertIs(self.getMsg(' ', timeout=0.5), None)
+                self.assertEqual(nb_mock_calls, 3)
+                timeFastForward(67)
+                cb._feed_scheduler.wakeup()
+                self.assertIs(self.getMsg(' ', timeout=0.5), None)
+                self.assertEqual(nb_mock_calls, 4)
+        finally:
+            self.assertNotError('config channel plugins.Phabricator.announce False')
+
+    def testDisablePush(self):
+        nb_mock_calls = 0
 
+        class MockConduit(BaseMockConduit):
+            class feed:
+                @classmethod
+                def query(cls, **kwargs):
+                    nonlocal nb_mock_calls
+                    nb_mock_calls += 1
+                    return query_feed(FEED1, **kwargs)
+
+        def mock_get_conduit(*args):
+            return MockConduit
+        cb = self.irc.getCallback('Phabricator')
+        cb.conduit_for_host_token = mock_get_conduit
+
+        try:
+            self.assertNotError('config channel plugins.Phabricator.announce True')
+            cb._feed_scheduler.wakeup()
+            self.assertIs(self.getMsg(' ', timeout=0.5), None)
+            timeFastForward(cb.feed_push_min_interval)
+            self.assertHTTPResponse('/phabricator/forge.softwareheritage.org',
+                                    200, method='POST')
+            self.assertIs(self.getMsg(' ', timeout=0.5), None)
+            self.assertEqual(nb_mock_calls, 2)
+
+            # Hooks disabled: polled right away, then at the announce
+            # interval again.
+            timeFastForward(cb.feed_push_min_interval)
+            with conf.supybot.plugins.Phabricator.announce.push.context(
+                    False):
+                cb._feed_scheduler.wakeup()
+                # Unhooking the last callback stops the HTTP server, which
+                # may take a while.
+                for _ in range(50):
+                    if cb._feed_hook is None and nb_mock_calls == 3:
+                        break
+                    time.sleep(0.1)
+                self.assertEqual(cb._feed_scheduler._last_pushes, {})
+                self.assertEqual(nb_mock_calls, 3)
+                timeFastForward(67)
+                cb._feed_scheduler.wakeup()
+                self.assertIs(self.getMsg(' ', timeout=0.5), None)
+                self.assertEqual(nb_mock_calls, 4)
+        finally:
+            self.assertNotError('config channel plugins.Phabricator.announce False')
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: